@@ -2,17 +2,49 @@
 # -*- coding: utf-8 -*-
 """
 Descarga automática de adjuntos con cualquier término desde Gmail y compresión en ZIP.
-- Evita repetir descargas (usa processed_ids.json)
+- Evita repetir descargas (IDs procesados por palabra clave en glosas_estado.db)
 - Añade pausas automáticas para no superar límites
 - Comprime todos los archivos descargados en un archivo ZIP
 """
 
-import os, json, time, base64, re, sys, zipfile, traceback, logging, shutil
-from datetime import datetime, timedelta
+import os, json, time, base64, re, sys, zipfile, traceback, logging, shutil, sqlite3
+import argparse, cProfile, pstats, io, threading, asyncio, random, bisect, tracemalloc, tempfile
+import csv, hashlib, unicodedata, multiprocessing, urllib.parse, zlib, struct, uuid
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import httplib2
+import requests
+try:
+    import aiohttp  # Motor asíncrono (opcional: sin él se usa el motor secuencial)
+except ImportError:
+    aiohttp = None
+try:
+    import boto3  # Destino S3 compatible (opcional)
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+try:
+    import openpyxl  # Extracción de .xlsx (opcional)
+except ImportError:
+    openpyxl = None
+try:
+    import xlrd  # Extracción de .xls (opcional)
+except ImportError:
+    xlrd = None
+try:
+    import pypdf  # Texto de los PDF para el índice de búsqueda (opcional)
+except ImportError:
+    pypdf = None
 import tkinter as tk
 from tkinter import simpledialog, messagebox, ttk
 
@@ -43,12 +75,245 @@ CREDENTIALS = resource_path('credentials.json')
 TOKEN = os.path.join(APPDATA_DIR, 'token.json')
 PROCESSED_FILE = os.path.join(APPDATA_DIR, 'processed_ids.json')
 DOWNLOAD_DIR = os.path.join(APPDATA_DIR, 'downloads')
+MANIFEST_CSV = 'manifiesto.csv'
+MANIFEST_JSONL = 'manifiesto.jsonl'
+# Manifiestos dentro de un ZIP: 'manifiesto.csv' o, en los ZIP mensuales, uno por ejecución
+# 'manifiesto_{fecha}_{id de ejecución}.csv' (los anteriores no llevan el id)
+MANIFEST_ENTRY_PATTERN = re.compile(r'^manifiesto(?:_\d{8}_\d{6}(?:_[0-9a-f]{8})?)?\.(?:csv|jsonl)$')
+STATE_DB = os.path.join(APPDATA_DIR, 'glosas_estado.db')
+EXCEL_DB = os.path.join(APPDATA_DIR, 'glosas_excel.db')
+SEARCH_DB = os.path.join(APPDATA_DIR, 'glosas_busqueda.db')
 
 
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly'
 ]
 
+# Número de funciones que se listan en el resumen del perfilado
+PROFILE_TOP_N = 30
+
+# API REST de Gmail (usada directamente por el motor asíncrono)
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+
+# Cuota de Gmail: 250 unidades por segundo y usuario; se deja un margen de seguridad
+GMAIL_QUOTA_UNITS_PER_SEC = 200
+GMAIL_QUOTA_COST = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'attachments.get': 5,
+    'threads.get': 10,
+}
+
+# Solicitudes simultáneas del motor asíncrono
+DEFAULT_CONCURRENCY = 64
+HTTP_TIMEOUT = 120  # segundos
+MAX_RETRIES = 5
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Concurrencia adaptativa (AIMD): ventana inicial y mínima, factor de reducción y cuántas
+# veces la latencia habitual de una llamada se considera un pico
+AIMD_INITIAL_WINDOW = 8
+AIMD_MIN_WINDOW = 2
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_LATENCY_SPIKE = 3.0
+THROTTLE_STATUS = {429, 503}
+# Los adjuntos se comparan con otros de tamaño parecido: una clase por cada duplicación desde este tamaño
+AIMD_SIZE_CLASS_BYTES = 256 * 1024
+
+# Carriles de adjuntos por tamaño (body.size): desde qué tamaño un adjunto es grande,
+# trabajadores del carril de grandes y presupuesto de memoria de cada carril
+LARGE_ATTACHMENT_BYTES = 2 * 1024 * 1024
+LARGE_LANE_WORKERS = 8
+SMALL_LANE_MEMORY_MB = 64
+LARGE_LANE_MEMORY_MB = 256
+
+# Cada cuántos mensajes terminados se guarda el estado en el motor asíncrono
+STATE_SAVE_EVERY = 500
+
+# Subidas a S3: tamaño de parte multiparte, partes simultáneas por archivo y archivos simultáneos
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_PART_WORKERS = 4
+S3_UPLOAD_WORKERS = 8
+
+# Extracción de Excel: extensiones reconocidas y filas revisadas para encontrar el encabezado
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm', '.xls')
+EXCEL_HEADER_SCAN_ROWS = 20
+
+# Estimación previa: ejecuciones recientes promediadas y valores cuando aún no hay historial
+ESTIMATE_HISTORY_RUNS = 10
+ESTIMATE_DEFAULTS = {
+    'sync': {'adjuntos_por_mensaje': 1.0, 'bytes_por_adjunto': 200_000, 'mensajes_por_segundo': 2.0},
+    'async': {'adjuntos_por_mensaje': 1.0, 'bytes_por_adjunto': 200_000, 'mensajes_por_segundo': 25.0},
+}
+
+# Niveles de correos reenviados (message/rfc822) que se abren para buscar adjuntos
+MIME_MAX_FORWARD_DEPTH = 5
+
+# Nombres de meses en español para las carpetas Año-Mes
+MONTH_NAMES = {
+    1: "Enero", 2: "Febrero", 3: "Marzo", 4: "Abril",
+    5: "Mayo", 6: "Junio", 7: "Julio", 8: "Agosto",
+    9: "Septiembre", 10: "Octubre", 11: "Noviembre", 12: "Diciembre"
+}
+MONTH_NUMBERS = {name: number for number, name in MONTH_NAMES.items()}
+
+# Identificadores en el nombre del archivo: '{tipo} {NIT}_{factura}' (p. ej. GLOSAS PRESTADOR 760010379901_200515846).
+# Solo el guion bajo separa NIT y factura; un dígito de verificación '-DV' tras el NIT se descarta.
+# El NIT tiene 9 dígitos (10 con el de verificación pegado) o es el código de habilitación de 12;
+# una fecha y hora 'AAAAMMDD_HHMMSS' (GLOSAS 20251121_100112.zip) no es un identificador
+FILENAME_ID_PATTERN = re.compile(
+    r'(?P<tipo>[^\d]*?)\s*(?<!\d)(?!\d{8}_\d{6}(?!\d))(?P<nit>\d{12}|\d{9,10})(?:-\d)?'
+    r'_(?P<factura>[A-Za-z]{0,6}\d+)(?![A-Za-z\d])'
+)
+
+# Índice de búsqueda: caracteres de texto guardados por documento y resultados por consulta
+SEARCH_MAX_TEXT = 1_000_000
+SEARCH_LIMIT = 50
+
+# Segundos entre revisiones del buzón en modo vigilancia
+WATCH_INTERVAL = 60
+
+# Segundos antes de la expiración en los que se refresca el token en segundo plano
+TOKEN_REFRESH_MARGIN = 300
+
+# Formatos ya comprimidos: van al ZIP sin comprimir (STORED) y su contenido se copia con el kernel
+STORED_EXTENSIONS = ('.pdf', '.xlsx', '.xlsm', '.docx', '.zip', '.jpg', '.jpeg', '.png')
+# Atributos internos de zipfile.ZipFile que usa la copia sin búferes; si falta alguno se usa zipfile.write
+ZIPFILE_INTERNALS = ('_writecheck', '_didModify', 'fp', 'start_dir', 'filelist', 'NameToInfo')
+# Tamaño total de la carpeta de prueba del benchmark de empaquetado
+ZIP_BENCHMARK_MB = 2048
+
+# Escritura en segundo plano: bytes descargados que pueden esperar en memoria a ser escritos
+WRITE_BEHIND_MB = 128
+# Un lote se cierra con este número de archivos o tras esperar este tiempo (s) a que lleguen más
+WRITE_BEHIND_BATCH_FILES = 64
+WRITE_BEHIND_LINGER = 0.1
+
+# Mensajes nuevos que se acumulan en memoria antes de escribirlos en la caché de metadatos
+CACHE_FLUSH_EVERY = 200
+
+# IDs nuevos que se acumulan antes de fusionarlos en el arreglo ordenado del índice compacto
+ID_INDEX_MERGE_EVERY = 4096
+
+
+# ============================
+# PERFILADO
+# ============================
+class StageTimer:
+    """Acumula tiempo de pared y de CPU por etapa (API, base64, disco, interfaz...)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Mide el bloque y lo suma a la etapa indicada"""
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def record(self, name, wall, cpu=0.0):
+        """Suma una medición ya tomada (p. ej. una espera asíncrona, sin CPU asociada)"""
+        with self._lock:
+            entry = self.stats.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+    def summary_lines(self):
+        """Tabla de etapas ordenada por tiempo de pared"""
+        with self._lock:
+            rows = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        lines = [f"{'Etapa':<20} {'Llamadas':>9} {'Pared (s)':>11} {'CPU (s)':>10}"]
+        for name, (count, wall, cpu) in rows:
+            lines.append(f"{name:<20} {count:>9} {wall:>11.3f} {cpu:>10.3f}")
+        return lines
+
+
+STAGES = StageTimer()
+
+
+def run_profiled(func, *args, mode='auto', top_n=PROFILE_TOP_N, **kwargs):
+    """Ejecuta func bajo un perfilador y deja los resultados junto al log"""
+    sampler = None
+    if mode in ('auto', 'muestreo'):
+        try:
+            from pyinstrument import Profiler
+            sampler = Profiler()
+        except ImportError:
+            if mode == 'muestreo':
+                logging.warning("pyinstrument no está instalado, se usará cProfile")
+    profiler = None if sampler else cProfile.Profile()
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base_path = os.path.join(APPDATA_DIR, f"profile_{timestamp}")
+    logging.info(f"Perfilado activado ({'muestreo' if sampler else 'cProfile'})")
+
+    STAGES.reset()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if sampler:
+        sampler.start()
+    else:
+        profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if sampler:
+            sampler.stop()
+        else:
+            profiler.disable()
+        wall_total = time.perf_counter() - wall_start
+        cpu_total = time.process_time() - cpu_start
+        try:
+            write_profile_report(base_path, profiler, sampler, wall_total, cpu_total, top_n)
+        except Exception as e:
+            logging.error(f"No se pudo guardar el perfilado: {e}")
+
+
+def write_profile_report(base_path, profiler, sampler, wall_total, cpu_total, top_n):
+    """Guarda el perfil completo y un resumen de texto con las etapas y el top-N"""
+    lines = [
+        f"Perfil de ejecución - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Tiempo de pared total: {wall_total:.3f} s",
+        f"Tiempo de CPU total:   {cpu_total:.3f} s",
+        "",
+        "Tiempo por etapa:",
+    ]
+    lines.extend(STAGES.summary_lines())
+    lines.append("")
+
+    if sampler:
+        profile_path = base_path + '.html'
+        with open(profile_path, 'w', encoding='utf-8') as f:
+            f.write(sampler.output_html())
+        lines.append("Perfil por muestreo:")
+        lines.append(sampler.output_text(unicode=True, color=False))
+    else:
+        profile_path = base_path + '.prof'
+        profiler.dump_stats(profile_path)
+        buffer = io.StringIO()
+        stats = pstats.Stats(profiler, stream=buffer)
+        stats.sort_stats('cumulative').print_stats(top_n)
+        lines.append(f"Top {top_n} funciones por tiempo acumulado:")
+        lines.append(buffer.getvalue())
+
+    summary_path = base_path + '.txt'
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines))
+
+    logging.info(f"Perfil guardado en: {profile_path}")
+    logging.info(f"Resumen del perfil guardado en: {summary_path}")
+    for line in STAGES.summary_lines():
+        logging.info(line)
+
 
 # ============================
 # VENTANA DE PROGRESO
@@ -184,7 +449,8 @@ class ProgressWindow:
         if not any(icon in status for icon in ['⏳', '✅', '📦', '🔍']):
             status = f"⏳ {status}"
         self.status_label.config(text=status)
-        self.window.update()
+        with STAGES.stage('tk.update'):
+            self.window.update()
 
     def update_progress(self, current, total):
         """Actualiza la barra de progreso"""
@@ -193,28 +459,193 @@ class ProgressWindow:
             self.progress_bar['value'] = percentage
             self.progress_label.config(text=f"{percentage:.1f}%")
             self.messages_label.config(text=f"📧 Mensajes procesados: {current} / {total}")
-        self.window.update()
+        with STAGES.stage('tk.update'):
+            self.window.update()
 
     def update_files(self, count):
         """Actualiza el contador de archivos descargados"""
         self.files_label.config(text=f"📥 Archivos descargados: {count}")
-        self.window.update()
+        with STAGES.stage('tk.update'):
+            self.window.update()
 
     def update_current_file(self, filename):
         """Actualiza el archivo actual siendo descargado"""
         if len(filename) > 70:
             filename = filename[:67] + "..."
         self.current_file_label.config(text=f"📄 Descargando: {filename}")
-        self.window.update()
+        with STAGES.stage('tk.update'):
+            self.window.update()
 
     def close(self):
         """Cierra la ventana de progreso"""
         self.window.destroy()
 
 
+# ============================
+# ESCRITURA SEGURA
+# ============================
+@contextmanager
+def file_lock(path, timeout=30):
+    """Bloqueo exclusivo entre procesos sobre un archivo .lock junto a path"""
+    with open(path + '.lock', 'a+') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"No se pudo bloquear {path}")
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def archive_lock(path):
+    """Bloqueo entre procesos de un ZIP mensual; el .lock va en APPDATA_DIR y no junto al ZIP"""
+    return file_lock(os.path.join(APPDATA_DIR, os.path.basename(path)))
+
+def process_alive(pid):
+    """Indica si el proceso pid sigue en ejecución"""
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        # PROCESS_QUERY_LIMITED_INFORMATION; sin permiso para abrirlo el proceso igual existe
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return ctypes.get_last_error() == 5
+        try:
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+PARTIAL_SUFFIX = '.part'
+# Copia del directorio central de un ZIP mensual mientras se le anexan entradas
+ARCHIVE_JOURNAL_SUFFIX = '.diario'
+
+# Sufijo que añade partial_path: '.{pid}.{hilo}.part'
+PARTIAL_NAME_PATTERN = re.compile(r'\.(\d+)\.\d+' + re.escape(PARTIAL_SUFFIX) + '$')
+
+def partial_path(path):
+    """Ruta temporal junto a path; la extensión .part la identifica en la recuperación"""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}{PARTIAL_SUFFIX}"
+
+@contextmanager
+def atomic_output(path):
+    """Entrega una ruta temporal para escribir; al salir sin error hace fsync y la renombra a path"""
+    tmp_path = partial_path(path)
+    try:
+        yield tmp_path
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write(path, data):
+    """Escribe en un temporal del mismo directorio, hace fsync y lo renombra sobre path"""
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, mode, **({} if mode == 'wb' else {'encoding': 'utf-8'})) as f:
+            f.write(data)
+
+def desktop_dir():
+    return os.path.join(os.path.expanduser('~'), 'Desktop')
+
+def restore_appended_archive(journal_path):
+    """Devuelve un ZIP mensual al estado previo a un anexo interrumpido.
+
+    Las entradas nuevas se escriben desde el inicio del directorio central: basta con
+    truncar ahí y volver a escribir el directorio central guardado en el diario.
+    """
+    path = journal_path[:-len(ARCHIVE_JOURNAL_SUFFIX)]
+    with open(journal_path, 'rb') as f:
+        start_dir, = struct.unpack('<Q', f.read(8))
+        tail = f.read()
+    with open(path, 'r+b') as f:
+        f.truncate(start_dir)
+        f.seek(start_dir)
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(journal_path)
+
+def remove_stale_partials(directory, names):
+    """Elimina de directory los temporales de partial_path cuyo proceso ya terminó; devuelve sus nombres.
+
+    Los de un proceso vivo (otra ejecución o el modo vigilancia) se respetan, y un adjunto que
+    simplemente termina en .part no tiene el formato '.{pid}.{hilo}.part'.
+    """
+    removed = set()
+    for name in names:
+        match = PARTIAL_NAME_PATTERN.search(name)
+        if not match or process_alive(int(match.group(1))):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            os.remove(path)
+            removed.add(name)
+            logging.warning(f"Eliminado archivo parcial de una ejecución interrumpida: {path}")
+        except OSError as e:
+            logging.warning(f"No se pudo eliminar archivo parcial {path}: {e}")
+    return removed
+
+def recover_partial_outputs():
+    """Deja como estaban los ZIP mensuales con un anexo interrumpido y limpia los temporales huérfanos
+    de APPDATA_DIR y del Escritorio (las carpetas de destino se limpian al listarlas, ver LocalDirectorySink)"""
+    removed = 0
+    if os.path.isdir(desktop_dir()):
+        for name in sorted(os.listdir(desktop_dir())):
+            if not name.endswith('.zip' + ARCHIVE_JOURNAL_SUFFIX):
+                continue
+            journal_path = os.path.join(desktop_dir(), name)
+            try:
+                # Quien anexa tiene el bloqueo hasta borrar el diario: si lo soltó, el diario ya no está
+                with archive_lock(journal_path[:-len(ARCHIVE_JOURNAL_SUFFIX)]):
+                    if os.path.exists(journal_path):
+                        restore_appended_archive(journal_path)
+                        logging.warning(f"Restaurado {name[:-len(ARCHIVE_JOURNAL_SUFFIX)]} tras un anexo interrumpido")
+            except TimeoutError:
+                logging.warning(f"Otra ejecución sigue anexando a {name[:-len(ARCHIVE_JOURNAL_SUFFIX)]}")
+        removed += len(remove_stale_partials(desktop_dir(), os.listdir(desktop_dir())))
+    for root_dir, dirs, files in os.walk(APPDATA_DIR):
+        removed += len(remove_stale_partials(root_dir, files))
+    return removed
+
 # ============================
 # AUTENTICACIÓN
 # ============================
+def save_token(creds):
+    """Guarda token.json de forma atómica y con bloqueo para no corromperlo entre procesos"""
+    with file_lock(TOKEN):
+        atomic_write(TOKEN, creds.to_json())
+    logging.info(f"Token guardado en: {TOKEN}")
+
 def get_credentials():
     try:
         logging.info("Iniciando proceso de autenticación...")
@@ -252,15 +683,74 @@ def get_credentials():
                 creds = flow.run_local_server(port=0)
                 logging.info("Autenticación completada exitosamente")
 
-            with open(TOKEN, 'w') as token:
-                token.write(creds.to_json())
-                logging.info(f"Token guardado en: {TOKEN}")
+            save_token(creds)
 
         return creds
     except Exception as e:
         logging.error(f"Error en autenticación: {str(e)}")
         raise Exception(f"Error al autenticar con Google: {str(e)}")
 
+class CredentialManager:
+    """Comparte un único token entre todos los trabajadores y lo refresca antes de que expire"""
+    def __init__(self, creds, margin=TOKEN_REFRESH_MARGIN):
+        self.creds = creds
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='glosas-token', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _seconds_until_refresh(self):
+        if not self.creds.expiry:
+            return None
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (self.creds.expiry - now).total_seconds() - self.margin
+
+    def _run(self):
+        """Hilo de fondo: duerme hasta `margin` segundos antes de la expiración y refresca"""
+        while not self._stop.is_set():
+            wait = self._seconds_until_refresh()
+            if wait is None or wait > 0:
+                self._stop.wait(min(wait or self.margin, self.margin))
+                continue
+            try:
+                self.refresh(self.creds.token)
+            except Exception as e:
+                logging.warning(f"Fallo al refrescar token en segundo plano: {e}")
+                self._stop.wait(30)
+
+    def refresh(self, stale_token=None):
+        """Refresca una sola vez aunque varios trabajadores lo pidan con el mismo token viejo"""
+        with self._lock:
+            if self.creds.valid and self.creds.token != stale_token:
+                return
+            logging.info("Refrescando token de acceso...")
+            with STAGES.stage('token.refresh'):
+                self.creds.refresh(Request())
+            save_token(self.creds)
+
+    def token(self):
+        """Token vigente; solo bloquea si el refresco de fondo no llegó a tiempo"""
+        token = self.creds.token
+        if not self.creds.valid:
+            self.refresh(token)
+            token = self.creds.token
+        return token
+
+    async def token_async(self):
+        if self.creds.valid:
+            return self.creds.token
+        return await asyncio.get_running_loop().run_in_executor(None, self.token)
+
 # ============================
 # CARGAR/SALVAR ESTADO
 # ============================
@@ -440,7 +930,7 @@ def get_date_range(parent_window):
         return None
 
 def load_processed_ids():
-    """Carga los IDs de correos ya procesados desde el archivo JSON"""
+    """Carga los IDs del processed_ids.json de versiones anteriores (para migrarlos)"""
     if os.path.exists(PROCESSED_FILE):
         try:
             with open(PROCESSED_FILE, 'r', encoding='utf-8') as f:
@@ -461,20 +951,404 @@ def load_processed_ids():
     logging.info("No hay IDs procesados previamente")
     return set()
 
-def save_processed_ids(ids):
-    """Guarda los IDs de correos procesados en el archivo JSON"""
-    try:
-        with open(PROCESSED_FILE, 'w', encoding='utf-8') as f:
-            json.dump(list(ids), f, indent=2)
-        logging.info(f"Guardados {len(ids)} IDs procesados")
-    except Exception as e:
-        logging.error(f"Error al guardar processed_ids: {e}")
-        raise
+MASK64 = (1 << 64) - 1
+
+def gmail_id_to_int(msg_id):
+    """Los IDs de Gmail son enteros de 64 bits en hexadecimal; SQLite los guarda con signo"""
+    value = int(msg_id, 16)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+class CompactIdIndex:
+    """Conjunto de IDs de 64 bits en un array('Q') ordenado con búsqueda binaria (8 bytes por ID).
+
+    Las altas van a un búfer pequeño que se fusiona por lotes con el arreglo.
+    """
+    def __init__(self, sorted_values=None):
+        self._sorted = sorted_values if sorted_values is not None else array('Q')
+        self._recent = set()
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, value):
+        value &= MASK64
+        if value in self._recent:
+            return True
+        i = bisect.bisect_left(self._sorted, value)
+        return i < len(self._sorted) and self._sorted[i] == value
+
+    def add(self, value):
+        """Agrega el ID; devuelve False si ya estaba"""
+        value &= MASK64
+        if value in self:
+            return False
+        self._recent.add(value)
+        # El umbral crece con el índice para que el costo de fusionar se amortice
+        if len(self._recent) >= max(ID_INDEX_MERGE_EVERY, len(self._sorted) >> 6):
+            self._merge()
+        return True
+
+    def discard(self, value):
+        """Quita el ID si está"""
+        value &= MASK64
+        if value in self._recent:
+            self._recent.discard(value)
+            return
+        i = bisect.bisect_left(self._sorted, value)
+        if i < len(self._sorted) and self._sorted[i] == value:
+            del self._sorted[i]
+
+    def _merge(self):
+        """Intercala el búfer en el arreglo copiando tramos contiguos (sin pasar por objetos int)"""
+        merged = array('Q')
+        start = 0
+        for value in sorted(self._recent):
+            pos = bisect.bisect_left(self._sorted, value, start)
+            merged.extend(self._sorted[start:pos])
+            merged.append(value)
+            start = pos
+        merged.extend(self._sorted[start:])
+        self._sorted = merged
+        self._recent = set()
+
+class ProcessedState:
+    """Mensajes ya procesados por palabra clave, guardados como enteros de 64 bits en SQLite"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS matchers (
+            id INTEGER PRIMARY KEY,
+            keyword TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS processed (
+            matcher_id INTEGER NOT NULL,
+            msg_id INTEGER NOT NULL,
+            PRIMARY KEY (matcher_id, msg_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS history_cursor (
+            matcher_id INTEGER PRIMARY KEY,
+            history_id INTEGER NOT NULL,
+            updated_at INTEGER
+        );
+    """
+
+    def __init__(self, keyword, path=STATE_DB):
+        # 'glosas' y 'GLOSAS' son la misma búsqueda en Gmail: el estado va en mayúsculas
+        self.keyword = keyword.strip().upper()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._migrate_cursor_table()
+        self.matcher_id = self._matcher_id(self.keyword)
+        self._merge_case_variants()
+        self._migrate_legacy_file()
+        self._ids = self._load_index()
+        self._new = []
+        logging.info(f"Cargados {len(self._ids)} IDs procesados previamente para '{self.keyword}'")
+
+    def _load_index(self):
+        """Carga los IDs ya ordenados por la clave primaria directamente en un array('Q')"""
+        rows = self._conn.execute(
+            "SELECT msg_id FROM processed WHERE matcher_id = ? ORDER BY msg_id", (self.matcher_id,)
+        )
+        # Orden con signo: los IDs >= 2**63 (negativos en SQLite) llegan primero y van al final
+        negatives, values = array('Q'), array('Q')
+        for (value,) in rows:
+            (negatives if value < 0 else values).append(value & MASK64)
+        values.extend(negatives)
+        return CompactIdIndex(values)
+
+    def _matcher_id(self, keyword):
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO matchers (keyword) VALUES (?)", (keyword,))
+        return self._conn.execute("SELECT id FROM matchers WHERE keyword = ?", (keyword,)).fetchone()[0]
+
+    def _migrate_cursor_table(self):
+        """Agrega la fecha del cursor a bases creadas antes de que se guardara"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(history_cursor)")}
+        if 'updated_at' not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE history_cursor ADD COLUMN updated_at INTEGER")
+
+    def _merge_case_variants(self):
+        """Pasa a la palabra en mayúsculas los IDs y el cursor guardados con otra escritura ('glosas', 'Glosas')"""
+        variants = [matcher_id for matcher_id, keyword in self._conn.execute("SELECT id, keyword FROM matchers")
+                    if matcher_id != self.matcher_id and keyword.strip().upper() == self.keyword]
+        if not variants:
+            return
+        with self._conn:
+            for matcher_id in variants:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO processed SELECT ?, msg_id FROM processed WHERE matcher_id = ?",
+                    (self.matcher_id, matcher_id)
+                )
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO history_cursor SELECT ?, history_id, updated_at FROM history_cursor "
+                    "WHERE matcher_id = ?", (self.matcher_id, matcher_id)
+                )
+                for table, column in (('processed', 'matcher_id'), ('history_cursor', 'matcher_id'),
+                                      ('matchers', 'id')):
+                    self._conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (matcher_id,))
+        logging.info(f"Unidos {len(variants)} estados anteriores de '{self.keyword}' escritos con otras mayúsculas")
+
+    def _migrate_legacy_file(self):
+        """Importa processed_ids.json de versiones anteriores, para la palabra clave de esta ejecución, y lo deja renombrado"""
+        if not os.path.exists(PROCESSED_FILE):
+            return
+        legacy_ids = load_processed_ids()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO processed VALUES (?, ?)",
+                ((self.matcher_id, gmail_id_to_int(msg_id)) for msg_id in legacy_ids)
+            )
+        os.replace(PROCESSED_FILE, PROCESSED_FILE + '.migrado')
+        logging.info(f"Migrados {len(legacy_ids)} IDs de processed_ids.json a la palabra clave '{self.keyword}'")
+
+    def __contains__(self, msg_id):
+        return gmail_id_to_int(msg_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, msg_id):
+        value = gmail_id_to_int(msg_id)
+        with self._lock:
+            if self._ids.add(value):
+                self._new.append(value)
+
+    def save(self, wait=None):
+        """Guarda solo los IDs agregados desde el último guardado.
+
+        wait (AttachmentStore.flush) se llama después de tomar esos IDs: espera a que sus archivos estén
+        en el destino y devuelve los mensajes con escrituras fallidas, que no se guardan.
+        """
+        try:
+            with self._lock:
+                new, self._new = self._new, []
+            failed = {gmail_id_to_int(msg_id) for msg_id in wait() if msg_id} if wait else set()
+            with self._lock:
+                if failed:
+                    # Fuera del índice en memoria también: un ciclo posterior los vuelve a intentar
+                    for value in failed:
+                        self._ids.discard(value)
+                    skipped = len(new)
+                    new = [value for value in new if value not in failed]
+                    skipped -= len(new)
+                    if skipped:
+                        logging.warning(f"{skipped} mensajes con archivos sin escribir no se marcan como procesados")
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO processed VALUES (?, ?)",
+                        ((self.matcher_id, value) for value in new)
+                    )
+            logging.info(f"Guardados {len(new)} IDs procesados nuevos ({len(self._ids)} en total)")
+        except Exception as e:
+            logging.error(f"Error al guardar IDs procesados: {e}")
+            raise
+
+    def get_history_id(self):
+        """Último historyId revisado por el modo vigilancia (None si nunca se ha ejecutado)"""
+        row = self._conn.execute(
+            "SELECT history_id FROM history_cursor WHERE matcher_id = ?", (self.matcher_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_history_updated(self):
+        """Momento (epoch) en que se guardó el cursor; None si nunca se guardó o es de una versión anterior"""
+        row = self._conn.execute(
+            "SELECT updated_at FROM history_cursor WHERE matcher_id = ?", (self.matcher_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_history_id(self, history_id, wait=None):
+        # Se guarda junto con los IDs pendientes: el cursor nunca avanza sin ellos
+        self.save(wait)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history_cursor VALUES (?, ?, ?)",
+                (self.matcher_id, int(history_id), int(time.time()))
+            )
+
+    def close(self, wait=None):
+        self.save(wait)
+        self._conn.close()
+
+class RunHistory:
+    """Rendimiento de ejecuciones anteriores, para estimar la duración de la siguiente"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ejecuciones (
+            id INTEGER PRIMARY KEY,
+            fecha TEXT NOT NULL,
+            palabra_clave TEXT NOT NULL,
+            motor TEXT NOT NULL,
+            mensajes INTEGER NOT NULL,
+            adjuntos INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            segundos REAL NOT NULL,
+            llamadas_api INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path=STATE_DB):
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(self.SCHEMA)
+
+    def record(self, keyword, engine, messages, attachments, size, seconds, api_calls):
+        if not messages:
+            return
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO ejecuciones (fecha, palabra_clave, motor, mensajes, adjuntos, bytes, segundos, "
+                "llamadas_api) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec='seconds'), keyword, engine, messages, attachments,
+                 size, seconds, api_calls)
+            )
+
+    def rates(self, engine):
+        """Promedios de las últimas ejecuciones del motor (o los valores por defecto si no hay)"""
+        row = self._conn.execute(
+            "SELECT SUM(mensajes), SUM(adjuntos), SUM(bytes), SUM(segundos) FROM "
+            "(SELECT * FROM ejecuciones WHERE motor = ? ORDER BY id DESC LIMIT ?)",
+            (engine, ESTIMATE_HISTORY_RUNS)
+        ).fetchone()
+        messages, attachments, size, seconds = row
+        if not messages or not seconds:
+            return dict(ESTIMATE_DEFAULTS[engine], historico=False)
+        return {
+            'adjuntos_por_mensaje': attachments / messages,
+            'bytes_por_adjunto': size / attachments if attachments else ESTIMATE_DEFAULTS[engine]['bytes_por_adjunto'],
+            'mensajes_por_segundo': messages / seconds,
+            'historico': True,
+        }
+
+    def close(self):
+        self._conn.close()
+
+# ============================
+# CACHÉ DE METADATOS
+# ============================
+class MetadataCache:
+    """Caché persistente (SQLite) de fecha, encabezados y partes con archivo de cada mensaje"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            internal_date INTEGER,
+            sender TEXT,
+            subject TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS parts (
+            msg_id TEXT NOT NULL,
+            part_id TEXT,
+            filename TEXT NOT NULL,
+            mime_type TEXT,
+            size INTEGER,
+            attachment_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_parts_msg ON parts(msg_id);
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, msg_id):
+        """Mensaje en la misma forma que devuelve messages.get (solo lo necesario), o None"""
+        with self._lock:
+            msg_data = self._pending.get(msg_id) or self._load(msg_id)
+            if msg_data:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return msg_data
+
+    def _load(self, msg_id):
+        row = self._conn.execute(
+            "SELECT thread_id, internal_date, sender, subject FROM messages WHERE id = ?", (msg_id,)
+        ).fetchone()
+        if not row:
+            return None
+        thread_id, internal_date, sender, subject = row
+        parts = [
+            {'partId': part_id, 'filename': filename, 'mimeType': mime_type,
+             'body': {'size': size, 'attachmentId': attachment_id}}
+            for part_id, filename, mime_type, size, attachment_id in self._conn.execute(
+                "SELECT part_id, filename, mime_type, size, attachment_id FROM parts WHERE msg_id = ?",
+                (msg_id,)
+            )
+        ]
+        headers = [{'name': 'From', 'value': sender or ''}, {'name': 'Subject', 'value': subject or ''}]
+        return {
+            'id': msg_id,
+            'threadId': thread_id,
+            'internalDate': str(internal_date) if internal_date is not None else None,
+            'payload': {'headers': headers, 'parts': parts},
+        }
+
+    def put(self, msg_data):
+        """Guarda el resumen del mensaje; se escribe en disco por lotes"""
+        summary = summarize_message(msg_data)
+        with self._lock:
+            self._pending[msg_data['id']] = summary
+            if len(self._pending) >= CACHE_FLUSH_EVERY:
+                self._flush()
+        return summary
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self._conn:
+            for msg_id, msg_data in self._pending.items():
+                headers = {h['name']: h['value'] for h in msg_data['payload']['headers']}
+                self._conn.execute("DELETE FROM parts WHERE msg_id = ?", (msg_id,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                    (msg_id, msg_data.get('threadId'), msg_data.get('internalDate'),
+                     headers.get('From'), headers.get('Subject'))
+                )
+                self._conn.executemany(
+                    "INSERT INTO parts VALUES (?, ?, ?, ?, ?, ?)",
+                    [(msg_id, part.get('partId'), part['filename'], part.get('mimeType'),
+                      part['body'].get('size'), part['body'].get('attachmentId'))
+                     for part in msg_data['payload']['parts']]
+                )
+        self._pending = {}
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+        logging.info(f"Caché de metadatos: {self.hits} aciertos, {self.misses} consultas a la API")
+
+
+def summarize_message(msg_data):
+    """Reduce un mensaje completo a fecha, remitente, asunto y partes con nombre de archivo"""
+    payload = msg_data.get('payload', {})
+    headers = [h for h in payload.get('headers', []) if h.get('name') in ('From', 'Subject')]
+    parts = [
+        {'partId': part.get('partId'), 'filename': part['filename'], 'mimeType': part.get('mimeType'),
+         'body': {'size': part.get('body', {}).get('size'),
+                  'attachmentId': part.get('body', {}).get('attachmentId')}}
+        for part in iter_attachment_parts(payload)
+    ]
+    return {
+        'id': msg_data['id'],
+        'threadId': msg_data.get('threadId'),
+        'internalDate': msg_data.get('internalDate'),
+        'payload': {'headers': headers, 'parts': parts},
+    }
 
 # ============================
 # FUNCIONES PRINCIPALES
 # ============================
 def get_parts(payload):
+    """Recorrido recursivo original de todas las hojas MIME (referencia del benchmark 'mime')"""
     parts = []
     if 'parts' in payload:
         for p in payload['parts']:
@@ -483,7 +1357,41 @@ def get_parts(payload):
         parts.append(payload)
     return parts
 
-def download_attachment(service, msg_id, part, msg_date=None):
+def iter_attachment_parts(payload, keyword=None, max_forward_depth=MIME_MAX_FORWARD_DEPTH):
+    """Recorre el árbol MIME sin recursión y entrega solo adjuntos descargables, en orden.
+
+    Los cuerpos de texto/HTML y los contenedores se descartan sin crear listas intermedias;
+    el filtro por palabra clave se aplica antes de entregar la parte. Los correos reenviados
+    (message/rfc822) se abren hasta max_forward_depth niveles; más allá se entregan como .eml.
+    """
+    keyword = keyword.upper() if keyword else None
+    stack = [payload]
+    depth = 0
+    while stack:
+        part = stack.pop()
+        if part is None:
+            # Marca de fin de un correo reenviado
+            depth -= 1
+            continue
+        children = part.get('parts')
+        if children:
+            # Al revés en la pila para conservar el orden del mensaje
+            if part.get('mimeType') != 'message/rfc822':
+                stack.extend(reversed(children))
+                continue
+            if depth < max_forward_depth:
+                depth += 1
+                stack.append(None)
+                stack.extend(reversed(children))
+                continue
+        filename = part.get('filename')
+        if not filename or (keyword and keyword not in filename.upper()):
+            continue
+        if not part.get('body', {}).get('attachmentId'):
+            continue
+        yield part
+
+def download_attachment(service, msg_id, part, msg_date=None, store=None, sender=None, subject=None):
     """Descarga un archivo adjunto de un mensaje de Gmail y lo organiza por fecha"""
     try:
         filename = part.get('filename')
@@ -500,11 +1408,12 @@ def download_attachment(service, msg_id, part, msg_date=None):
         logging.info(f"Descargando adjunto: {filename}")
 
         # Obtener el adjunto de la API
-        att = service.users().messages().attachments().get(
-            userId='me',
-            messageId=msg_id,
-            id=att_id
-        ).execute()
+        with STAGES.stage('api.attachments'):
+            att = service.users().messages().attachments().get(
+                userId='me',
+                messageId=msg_id,
+                id=att_id
+            ).execute()
 
         data = att.get('data')
         if not data:
@@ -512,82 +1421,654 @@ def download_attachment(service, msg_id, part, msg_date=None):
             return None
 
         # Decodificar el contenido
-        file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
+        with STAGES.stage('base64'):
+            file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
 
-        # Si no hay fecha del mensaje, usar fecha actual
-        if msg_date is None:
-            msg_date = datetime.now()
-
-        # Nombres de meses en español
-        meses = {
-            1: "Enero", 2: "Febrero", 3: "Marzo", 4: "Abril",
-            5: "Mayo", 6: "Junio", 7: "Julio", 8: "Agosto",
-            9: "Septiembre", 10: "Octubre", 11: "Noviembre", 12: "Diciembre"
-        }
-
-        # Extraer año, mes y semana del año
-        year = msg_date.year
-        month_num = msg_date.month
-        month_name = f"{year}-{meses[month_num]}"  # 2025-Noviembre
-        week_number = msg_date.isocalendar()[1]  # Número de semana del año
-
-        # Crear estructura de carpetas dentro de DOWNLOAD_DIR: {Year-MonthName}/Semana_{N}/
-        month_folder = os.path.join(DOWNLOAD_DIR, month_name)
-        week_folder = os.path.join(month_folder, f"Semana_{week_number}")
-        os.makedirs(week_folder, exist_ok=True)
-
-        # Agregar fecha al nombre del archivo: YYYY-MM-DD_{original_filename}
-        date_prefix = msg_date.strftime("%Y-%m-%d")
-        new_filename = f"{date_prefix}_{filename}"
-
-        # Generar ruta única si el archivo ya existe
-        path = os.path.join(week_folder, new_filename)
-        if os.path.exists(path):
-            base, ext = os.path.splitext(new_filename)
-            path = os.path.join(week_folder, f"{base}_{int(time.time())}{ext}")
-            logging.info(f"Archivo duplicado, renombrado a: {os.path.basename(path)}")
-
-        # Guardar archivo
-        with open(path, 'wb') as f:
-            f.write(file_data)
-
-        file_size = len(file_data) / 1024  # KB
-        logging.info(f"Descargado exitosamente: {new_filename} ({file_size:.2f} KB) en {week_folder}")
-        return path
+        if store:
+            return store.save(file_data, filename, msg_date, msg_id, att_id, sender, subject)
+        return save_attachment(file_data, filename, msg_date)[0]
 
     except Exception as e:
         logging.error(f"Error al descargar adjunto {filename}: {e}")
         return None
 
-def create_zip_file(downloaded_files, keyword):
-    """Crea un archivo ZIP con estructura de carpetas organizadas por mes y semana, usando la palabra clave en el nombre"""
+def parse_filename_identifiers(filename):
+    """NIT del prestador y número de factura del nombre del archivo, o None si no los trae.
+
+    'GLOSAS PRESTADOR 760010379901_200515846.pdf' -> tipo 'GLOSAS PRESTADOR',
+    nit '760010379901', factura '200515846'. 'NIT 890303461-2 FE 12345.pdf' y
+    'GLOSAS 20251121_100112.zip' -> None.
+    """
+    match = FILENAME_ID_PATTERN.search(os.path.splitext(filename)[0])
+    if not match:
+        return None
+    return {
+        'tipo': ' '.join(match.group('tipo').replace('_', ' ').split()).upper(),
+        'nit': match.group('nit'),
+        'factura': match.group('factura').upper(),
+    }
+
+def save_attachment(file_data, filename, msg_date=None, planner=None, writer=None, on_written=None):
+    """Guarda un adjunto en el destino (por defecto DOWNLOAD_DIR) en la ruta que asigna el planificador.
+
+    Con writer la escritura queda en manos del hilo de E/S y la función vuelve sin tocar el disco.
+    on_written(ubicación, ruta relativa, ok) se llama cuando la escritura termina (desde el hilo de E/S si hay writer).
+    Devuelve (ubicación final, ruta relativa dentro del destino).
+    """
+    planner = planner or PathPlanner()
+    relpath = planner.plan(file_data, filename, msg_date)
+    location = planner.sink.location(relpath)
+
+    # Guardar archivo (el destino lo escribe de forma atómica: nunca queda un archivo truncado)
+    if writer:
+        writer.submit(relpath, file_data, (lambda ok: on_written(location, relpath, ok)) if on_written else None)
+    else:
+        try:
+            with STAGES.stage(planner.sink.stage_name):
+                planner.sink.put(relpath, file_data)
+        except Exception:
+            if on_written:
+                on_written(location, relpath, False)
+            raise
+        if on_written:
+            on_written(location, relpath, True)
+
+    file_size = len(file_data) / 1024  # KB
+    folder, new_filename = relpath.rsplit('/', 1)
+    logging.info(f"Descargado exitosamente: {new_filename} ({file_size:.2f} KB) en {folder}")
+    return location, relpath
+
+class PathPlanner:
+    """Asigna en memoria las rutas de salida: carpetas calculadas una vez y nombres sin colisiones"""
+    def __init__(self, sink=None, layout='fecha', archived=None):
+        self.sink = sink or LocalDirectorySink(DOWNLOAD_DIR)
+        self.layout = layout
+        # Carpeta -> nombres que ya están en un ZIP al que se va a anexar (ArchivedNames)
+        self.archived = archived
+        self._lock = threading.Lock()
+        # Día -> carpeta Año-Mes/Semana_N
+        self._week_folders = {}
+        # Carpeta -> Future con los nombres ocupados (los que ya había en el destino más los asignados)
+        self._taken = {}
+
+    def folder(self, filename, msg_date):
+        """Carpeta del archivo: Año-Mes/Semana_N, o Prestador_{NIT}[/Factura_{N}] según layout"""
+        if self.layout != 'fecha':
+            # Sin identificadores en el nombre se usa la fecha
+            ids = parse_filename_identifiers(filename)
+            if ids:
+                folder = f"Prestador_{ids['nit']}"
+                if self.layout == 'factura':
+                    folder += f"/Factura_{ids['factura']}"
+                return folder
+        day = msg_date.date()
+        folder = self._week_folders.get(day)
+        if folder is None:
+            # 2025-Noviembre/Semana_47 (número de semana ISO del año)
+            folder = f"{msg_date.year}-{MONTH_NAMES[msg_date.month]}/Semana_{msg_date.isocalendar()[1]}"
+            self._week_folders[day] = folder
+        return folder
+
+    def plan(self, file_data, filename, msg_date=None):
+        """Ruta relativa única para el archivo: {carpeta}/{YYYY-MM-DD}_{nombre}"""
+        # Si no hay fecha del mensaje, usar fecha actual
+        msg_date = msg_date or datetime.now()
+        folder = self.folder(filename, msg_date)
+        new_filename = f"{msg_date.strftime('%Y-%m-%d')}_{filename}"
+        taken = self._taken_names(folder)
+        with self._lock:
+            if new_filename in taken:
+                # Sufijo con el hash del contenido: el mismo archivo recibe el mismo nombre
+                # sin importar el orden de llegada; un contador resuelve el caso repetido
+                base, ext = os.path.splitext(new_filename)
+                stem = f"{base}_{hashlib.sha256(file_data).hexdigest()[:8]}"
+                candidate, n = f"{stem}{ext}", 1
+                while candidate in taken:
+                    n += 1
+                    candidate = f"{stem}_{n}{ext}"
+                logging.info(f"Archivo duplicado, renombrado a: {folder}/{candidate}")
+                new_filename = candidate
+            taken.add(new_filename)
+        return f"{folder}/{new_filename}"
+
+    def _taken_names(self, folder):
+        """Nombres ocupados de la carpeta: una sola consulta al destino por carpeta y ejecución.
+
+        La consulta (un LIST en S3) va fuera del bloqueo para que las de carpetas distintas no se esperen;
+        quien pide una carpeta que otro hilo está listando espera ese mismo resultado.
+        """
+        with self._lock:
+            listing = self._taken.get(folder)
+            owner = listing is None
+            if owner:
+                listing = self._taken[folder] = Future()
+        if owner:
+            try:
+                names = self.sink.listdir(folder)
+                if self.archived:
+                    names |= self.archived(folder)
+            except BaseException as e:
+                with self._lock:
+                    del self._taken[folder]
+                listing.set_exception(e)
+                raise
+            listing.set_result(names)
+        return listing.result()
+
+class AttachmentStore:
+    """Punto único de guardado de adjuntos: destino, nombres, manifiesto, Excel e índice de búsqueda"""
+    def __init__(self, planner=None, manifest=None, extractor=None, index=None, identifiers=None,
+                 writer=None):
+        self.planner = planner or PathPlanner()
+        self.sink = self.planner.sink
+        self.manifest = manifest
+        self.extractor = extractor
+        self.index = index
+        self.identifiers = identifiers
+        self.writer = writer
+        # Ubicación -> (CRC32, bytes) calculados sobre los datos descargados, para empaquetar sin releer
+        self.checksums = {}
+        # Escrituras fallidas: sus mensajes no se marcan como procesados ni sus archivos cuentan
+        self._lock = threading.Lock()
+        self.failed_messages = set()
+        self.failed_locations = set()
+        # Archivos ya escritos pendientes de registrar (el hilo de E/S solo los agrega aquí)
+        self._written = []
+
+    @property
+    def parallelism(self):
+        return self.sink.parallelism
+
+    def flush(self):
+        """Espera a que todo lo guardado esté en el destino (antes de marcar mensajes o empaquetar).
+
+        Devuelve los IDs de los mensajes con algún archivo que no se pudo escribir.
+        """
+        if self.writer:
+            self.writer.flush()
+        self._record_written()
+        with self._lock:
+            return set(self.failed_messages)
+
+    def save(self, file_data, filename, msg_date=None, msg_id=None, att_id=None, sender=None, subject=None):
+        # Suma y CRC una sola vez, en el hilo que descarga; el manifiesto y los índices los reutilizan
+        entry = {
+            'msg_id': msg_id, 'att_id': att_id, 'sender': sender, 'subject': subject,
+            'msg_date': msg_date, 'filename': filename, 'size': len(file_data),
+            'sha256': hashlib.sha256(file_data).hexdigest(), 'crc32': zlib.crc32(file_data),
+            # El contenido solo se conserva si la extracción de Excel o el índice lo van a leer
+            'data': file_data if self.index or (self.extractor and self.extractor.handles(filename)) else None,
+        }
+
+        def written(location, relpath, ok):
+            # En el hilo de E/S: solo anotar; el registro se hace fuera (en save o flush)
+            with self._lock:
+                if ok:
+                    self._written.append(dict(entry, location=location, relpath=relpath))
+                else:
+                    self.failed_messages.add(msg_id)
+                    self.failed_locations.add(location)
+
+        location = save_attachment(file_data, filename, msg_date, self.planner, self.writer, written)[0]
+        self._record_written()
+        return location
+
+    def _record_written(self):
+        """Registra lo que ya está en el destino: checksums, manifiesto, Excel, índice e identificadores"""
+        with self._lock:
+            written, self._written = self._written, []
+        if not written:
+            return
+        for entry in written:
+            self.checksums[os.path.normpath(entry['location'])] = (entry['crc32'], entry['size'])
+        if self.manifest:
+            self.manifest.record_many(written)
+        if self.extractor:
+            for entry in written:
+                if entry['data'] is not None:
+                    self.extractor.submit(entry['data'], entry['filename'], entry['location'], entry['msg_id'],
+                                          entry['att_id'], entry['sender'], entry['msg_date'], entry['sha256'])
+        if self.index:
+            self.index.submit_many(written)
+        if self.identifiers:
+            self.identifiers.add_many(written)
+
+class RunManifest:
+    """Manifiesto de la ejecución (CSV y JSON Lines) que se escribe a medida que se guarda cada archivo"""
+    FIELDS = ['id_mensaje', 'id_adjunto', 'remitente', 'fecha_mensaje', 'nombre_original',
+              'ruta_archivo', 'bytes', 'sha256']
+
+    def __init__(self, directory=DOWNLOAD_DIR):
+        self.directory = directory
+        self.csv_path = os.path.join(directory, MANIFEST_CSV)
+        self.jsonl_path = os.path.join(directory, MANIFEST_JSONL)
+        self._lock = threading.Lock()
+        self._csv_file = None
+        self._jsonl_file = None
+        self._writer = None
+        self.count = 0
+        self.bytes = 0
+
+    def _open(self):
+        # Se abren al primer registro y en modo anexar: si una ejecución interrumpida dejó
+        # archivos en DOWNLOAD_DIR, sus filas siguen en el manifiesto junto a ellos
+        os.makedirs(self.directory, exist_ok=True)
+        new_csv = not os.path.exists(self.csv_path)
+        self._csv_file = open(self.csv_path, 'a', newline='', encoding='utf-8')
+        self._jsonl_file = open(self.jsonl_path, 'a', encoding='utf-8')
+        self._writer = csv.DictWriter(self._csv_file, fieldnames=self.FIELDS)
+        if new_csv:
+            self._writer.writeheader()
+
+    def record_many(self, entries):
+        """Agrega las filas de varios archivos ya escritos (entradas de AttachmentStore) con un solo vaciado"""
+        rows = [{
+            'id_mensaje': entry['msg_id'],
+            'id_adjunto': entry['att_id'],
+            'remitente': entry['sender'] or '',
+            'fecha_mensaje': entry['msg_date'].isoformat(timespec='seconds') if entry['msg_date'] else '',
+            'nombre_original': entry['filename'],
+            'ruta_archivo': entry['relpath'],
+            'bytes': entry['size'],
+            'sha256': entry['sha256'],
+        } for entry in entries]
+        with self._lock:
+            if not self._writer:
+                self._open()
+            self._writer.writerows(rows)
+            self._jsonl_file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            self._csv_file.flush()
+            self._jsonl_file.flush()
+            self.count += len(rows)
+            self.bytes += sum(row['bytes'] for row in rows)
+
+    def close(self):
+        with self._lock:
+            for f in (self._csv_file, self._jsonl_file):
+                if f:
+                    f.close()
+            self._csv_file = self._jsonl_file = self._writer = None
+
+def copy_file_body(src_path, dst, size):
+    """Copia src_path al final del archivo abierto dst sin pasar por búferes de Python si se puede.
+
+    Usa copy_file_range (Linux), luego sendfile y por último una copia normal; devuelve el método.
+    """
+    dst.flush()
+    offset = dst.tell()
+    copied = 0
+    method = None
+    with open(src_path, 'rb') as src:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, offset + copied)
+                    if not n:
+                        break
+                    copied += n
+                method = 'copy_file_range'
+            except OSError:
+                pass  # Kernel antiguo o sistemas de archivos distintos: se sigue con lo copiado
+        if copied < size and hasattr(os, 'sendfile'):
+            try:
+                os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+                while copied < size:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                    if not n:
+                        break
+                    copied += n
+                method = 'sendfile'
+            except OSError:
+                pass  # En macOS sendfile solo escribe en sockets
+        if copied < size:
+            src.seek(copied)
+            dst.seek(offset + copied)
+            while copied < size:
+                chunk = src.read(min(1024 * 1024, size - copied))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                copied += len(chunk)
+            method = 'copia'
+    dst.seek(offset + size)
+    if copied != size:
+        raise Exception(f"{src_path} cambió de tamaño mientras se empaquetaba")
+    return method
+
+class ArchiveWriter:
+    """Escribe el ZIP en volúmenes por tamaño, número de archivos o mes, con un manifiesto JSON.
+
+    Los formatos ya comprimidos cuyo CRC32 se conoce (checksums) se guardan sin comprimir
+    y se copian con copy_file_range/sendfile; el resto pasa por zipfile con DEFLATE.
+    """
+    def __init__(self, base_path, max_bytes=None, max_files=None, split_by_month=False, checksums=None,
+                 append=False, volume_manifest=True):
+        self.base_path = base_path
+        # Con varios escritores en paralelo el índice lo escribe quien los coordina
+        self.volume_manifest = volume_manifest
+        # append: un ZIP por mes ({base_path}_{Año-Mes}.zip) al que se anexan las entradas nuevas
+        self.append = append
+        if append:
+            max_bytes, max_files, split_by_month = None, None, True
+        self.checksums = checksums or {}
+        self.stored = {}  # método de copia -> (entradas, bytes)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.split_by_month = split_by_month
+        self.multi_volume = bool(max_bytes or max_files or split_by_month)
+        self.volumes = []
+        self._zip = None
+        self._tmp_path = None
+        self._journal = None
+        self._lock = None
+        self._existing = 0
+        self._current = None
+        self._counters = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            # Un volumen que no pasa la verificación se deshace igual que una interrupción
+            self.abort()
+            raise
+
+    def _volume_path(self, month):
+        if self.append:
+            return f"{self.base_path}_{month}.zip"
+        if not self.multi_volume:
+            return f"{self.base_path}.zip"
+        key = month if self.split_by_month else None
+        self._counters[key] = self._counters.get(key, 0) + 1
+        label = f"{month}_{self._counters[key]:03d}" if self.split_by_month else f"{self._counters[key]:03d}"
+        return f"{self.base_path}_{label}.zip"
+
+    def _needs_rollover(self, size, month):
+        current = self._current
+        if self.split_by_month and month not in current['meses']:
+            return True
+        if self.max_files and current['archivos'] >= self.max_files:
+            return True
+        return bool(self.max_bytes and current['archivos'] and self._zip.fp.tell() + size > self.max_bytes)
+
+    def _open_volume(self, month):
+        path = self._volume_path(month)
+        if self.append:
+            # Otra ejecución (p. ej. el modo vigilancia) no anexa al mismo mes hasta que este se cierre
+            self._lock = ExitStack()
+            self._lock.enter_context(archive_lock(path))
+            if os.path.exists(path):
+                self._open_for_append(path)
+                return
+        self._existing = 0
+        self._tmp_path = partial_path(path)
+        # allowZip64: zipfile pasa a registros ZIP64 por entrada (>4 GiB) y en el directorio
+        # central (>65535 entradas o >4 GiB) cuando hace falta
+        self._zip = zipfile.ZipFile(self._tmp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._current = {'archivo': os.path.basename(path), 'ruta': path, 'bytes': 0,
+                         'archivos': 0, 'meses': [], 'contenido': []}
+        logging.info(f"Abriendo volumen: {self._current['archivo']}")
+
+    def _open_for_append(self, path):
+        """Abre el ZIP del mes para anexar: solo se reescribe su directorio central"""
+        self._zip = zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._existing = len(self._zip.infolist())
+        # Diario con el directorio central actual: si el anexo no termina, el ZIP se restaura
+        with open(path, 'rb') as f:
+            f.seek(self._zip.start_dir)
+            atomic_write(path + ARCHIVE_JOURNAL_SUFFIX, struct.pack('<Q', self._zip.start_dir) + f.read())
+        self._journal = path + ARCHIVE_JOURNAL_SUFFIX
+        self._tmp_path = None
+        self._current = {'archivo': os.path.basename(path), 'ruta': path, 'bytes': 0,
+                         'archivos': 0, 'meses': [], 'contenido': []}
+        logging.info(f"Anexando al volumen: {self._current['archivo']} ({self._existing} archivos previos)")
+
+    def _close_volume(self):
+        self._zip.close()
+        self._zip = None
+        path = self._current.pop('ruta')
+        written = path if self._journal else self._tmp_path
+        with open(written, 'rb+') as f:
+            os.fsync(f.fileno())
+        # Se verifica antes de borrar el diario o de renombrar el .part: si falla, abort() lo deshace
+        with zipfile.ZipFile(written) as check:
+            if len(check.infolist()) != self._existing + self._current['archivos']:
+                raise Exception(f"El volumen {path} no contiene todas las entradas")
+        if self._journal:
+            os.remove(self._journal)
+            self._journal = None
+        else:
+            os.replace(self._tmp_path, path)
+        self._current['bytes'] = os.path.getsize(path)
+        self._release_lock()
+        self.volumes.append((path, self._current))
+        logging.info(f"Volumen cerrado: {self._current['archivo']} "
+                     f"({self._current['archivos']} archivos, {self._current['bytes'] / 1e6:.1f} MB)")
+
+    def add(self, file_path, arcname, rollover=True):
+        month = arcname.replace(os.sep, '/').split('/')[0]
+        size = os.path.getsize(file_path)
+        if self._zip and rollover and self._needs_rollover(size, month):
+            self._close_volume()
+        if not self._zip:
+            self._open_volume(month)
+        checksum = self.checksums.get(os.path.normpath(file_path))
+        if (checksum and checksum[1] == size
+                and os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS):
+            self._write_stored(file_path, arcname, *checksum)
+        else:
+            self._zip.write(file_path, arcname)
+        self._current['archivos'] += 1
+        self._current['contenido'].append(arcname.replace(os.sep, '/'))
+        if rollover and month not in self._current['meses']:
+            self._current['meses'].append(month)
+
+    def _write_stored(self, file_path, arcname, crc, size):
+        """Entrada STORED con el CRC ya calculado: encabezado local propio y cuerpo copiado por el kernel"""
+        zf = self._zip
+        if not all(hasattr(zf, name) for name in ZIPFILE_INTERNALS):
+            zf.write(file_path, arcname, zipfile.ZIP_STORED)
+            self._count_stored('zipfile', size)
+            return
+        zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = size
+        zinfo.CRC = crc
+        # Mismos registros que zipfile.write: el directorio central lo escribe zipfile al cerrar
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zinfo.header_offset = zf.fp.tell()
+        zf.fp.write(zinfo.FileHeader())
+        method = copy_file_body(file_path, zf.fp, size)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        self._count_stored(method, size)
+
+    def _count_stored(self, method, size):
+        count, total = self.stored.get(method, (0, 0))
+        self.stored[method] = (count + 1, total + size)
+
+    def close(self):
+        """Cierra el último volumen y escribe el manifiesto; devuelve las rutas de los volúmenes"""
+        if self._zip:
+            self._close_volume()
+        for method, (count, total) in self.stored.items():
+            logging.info(f"Entradas sin compresión copiadas con {method}: {count} ({total / 1e6:.1f} MB)")
+        # Los ZIP mensuales se acumulan entre ejecuciones: sin manifiesto de volúmenes por ejecución
+        if self.multi_volume and self.volumes and self.volume_manifest and not self.append:
+            manifest = {
+                'creado': datetime.now().isoformat(timespec='seconds'),
+                'volumenes': [info for _, info in self.volumes],
+            }
+            manifest_path = f"{self.base_path}.volumenes.json"
+            atomic_write(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+            logging.info(f"Manifiesto de volúmenes guardado en: {manifest_path}")
+        return [path for path, _ in self.volumes]
+
+    def abort(self):
+        try:
+            if self._zip:
+                self._zip.close()
+        finally:
+            self._zip = None
+            if self._journal:
+                restore_appended_archive(self._journal)
+                self._journal = None
+            if self._tmp_path and os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+            self._release_lock()
+
+    def _release_lock(self):
+        if self._lock:
+            self._lock.close()
+            self._lock = None
+
+class ArchivedNames:
+    """Nombres que ya están en los ZIP mensuales, para que el planificador no los repita al anexar"""
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self._months = {}  # Año-Mes -> {carpeta: nombres}
+
+    def __call__(self, folder):
+        month = folder.split('/')[0]
+        folders = self._months.get(month)
+        if folders is None:
+            # Se publica ya completo: otro hilo del planificador puede estar consultando el mismo mes
+            folders = {}
+            path = f"{self.base_path}_{month}.zip"
+            if os.path.exists(path):
+                with zipfile.ZipFile(path) as zf:
+                    for name in zf.namelist():
+                        entry_folder, _, entry_name = name.rpartition('/')
+                        folders.setdefault(entry_folder, set()).add(entry_name)
+            self._months[month] = folders
+        return set(folders.get(folder, ()))
+
+def archive_base_path(keyword, timestamp=None):
+    """Ruta base de los ZIP en el escritorio: {PALABRA}_{fecha_hora}, o {PALABRA} para los mensuales"""
+    # Limpiar la palabra clave para nombre de archivo
+    safe_keyword = re.sub(r'[^A-Za-z0-9_-]', '', keyword.upper())
+    name = f"{safe_keyword}_{timestamp}" if timestamp else safe_keyword
+    return os.path.join(desktop_dir(), name)
+
+def month_folder_key(folder):
+    """Orden cronológico de las carpetas 'Año-Mes' (el nombre del mes no ordena bien como texto); las demás van después"""
+    year, _, month = folder.partition('-')
+    if year.isdigit() and month in MONTH_NUMBERS:
+        return (0, int(year), MONTH_NUMBERS[month], '')
+    return (1, 0, 0, folder)
+
+def write_archive_index(base_path, keyword, volumes):
+    """Índice {base}.indice.json con cada ZIP producido, su carpeta Año-Mes, archivos y tamaño"""
+    index_path = f"{base_path}.indice.json"
+    index = {
+        'creado': datetime.now().isoformat(timespec='seconds'),
+        'palabra_clave': keyword,
+        'zips': [{'carpeta': info['meses'][0] if info['meses'] else '', 'archivo': info['archivo'],
+                  'archivos': info['archivos'], 'bytes': info['bytes']} for _, info in volumes],
+    }
+    atomic_write(index_path, json.dumps(index, ensure_ascii=False, indent=2))
+    logging.info(f"Índice de ZIP guardado en: {index_path}")
+    return index_path
+
+def create_zip_file(downloaded_files, keyword, volume_mb=None, volume_files=None, volume_per_month=False,
+                    checksums=None, append_monthly=False, parallel_months=False):
+    """Crea el ZIP (o sus volúmenes) con estructura de carpetas por mes y semana, usando la palabra clave en el nombre.
+
+    checksums ({ruta: (CRC32, bytes)}, de AttachmentStore) permite copiar PDF y Excel sin releerlos.
+    Con append_monthly las entradas se anexan a {PALABRA}_{Año-Mes}.zip en lugar de crear un ZIP nuevo.
+    Con parallel_months cada carpeta Año-Mes va a su propio ZIP, construidos a la vez (uno por núcleo),
+    y se escribe un índice {base}.indice.json con todos.
+    """
     if not downloaded_files:
         logging.info("No hay archivos para comprimir")
-        return None
+        return []
 
     try:
-        # Obtener la ruta del escritorio del usuario
-        desktop = os.path.join(os.path.expanduser('~'), 'Desktop')
-
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        # Limpiar la palabra clave para nombre de archivo
-        safe_keyword = re.sub(r'[^A-Za-z0-9_-]', '', keyword.upper())
-        zip_filename = f"{safe_keyword}_{timestamp}.zip"
-        zip_path = os.path.join(desktop, zip_filename)
-
-        logging.info(f"Creando archivo ZIP con estructura de carpetas: {zip_filename}")
-
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Recorrer toda la estructura de carpetas en DOWNLOAD_DIR
-            for root_dir, dirs, files in os.walk(DOWNLOAD_DIR):
-                for file in files:
-                    file_path = os.path.join(root_dir, file)
-                    # Calcular la ruta relativa para mantener la estructura de carpetas
-                    arcname = os.path.relpath(file_path, DOWNLOAD_DIR)
-                    zipf.write(file_path, arcname)
+        # Los archivos propios de la ejecución (manifiesto, índice) llevan fecha y hora, también con ZIP mensuales
+        base_path = archive_base_path(keyword, timestamp)
+
+        logging.info(f"Creando archivo ZIP con estructura de carpetas: {os.path.basename(base_path)}")
+
+        # Cada volumen nuevo se escribe como .part y solo aparece con su nombre final cuando está completo;
+        # los mensuales existentes se abren para anexar con un diario de su directorio central
+        def new_writer():
+            return ArchiveWriter(
+                archive_base_path(keyword) if append_monthly else base_path,
+                max_bytes=volume_mb * 1024 * 1024 if volume_mb else None,
+                max_files=volume_files,
+                split_by_month=volume_per_month or parallel_months,
+                checksums=checksums,
+                append=append_monthly,
+                volume_manifest=not parallel_months
+            )
+
+        manifest_files = [os.path.join(DOWNLOAD_DIR, name) for name in (MANIFEST_CSV, MANIFEST_JSONL)]
+        # Recorrer toda la estructura de carpetas en DOWNLOAD_DIR (por meses en orden cronológico)
+        entries = []
+        for root_dir, dirs, files in os.walk(DOWNLOAD_DIR):
+            dirs.sort(key=month_folder_key)
+            for file in sorted(files):
+                file_path = os.path.join(root_dir, file)
+                if file_path in manifest_files:
+                    continue
+                # Calcular la ruta relativa para mantener la estructura de carpetas
+                entries.append((file_path, os.path.relpath(file_path, DOWNLOAD_DIR)))
+        # El manifiesto va dentro del último volumen y también junto al ZIP; en un ZIP mensual solo
+        # dentro, con la fecha y un id de ejecución (dos ejecuciones pueden caer en el mismo segundo)
+        run_id = uuid.uuid4().hex[:8]
+        manifest_entries = []
+        for file_path in manifest_files:
+            if os.path.exists(file_path):
+                stem, ext = os.path.splitext(os.path.basename(file_path))
+                manifest_entries.append(
+                    (file_path, f"{stem}_{timestamp}_{run_id}{ext}" if append_monthly else os.path.basename(file_path))
+                )
+
+        def write_volumes(month_entries, extra_entries):
+            with new_writer() as writer:
+                for file_path, arcname in month_entries:
+                    writer.add(file_path, arcname)
                     logging.info(f"Agregado al ZIP: {arcname}")
+                for file_path, arcname in extra_entries:
+                    writer.add(file_path, arcname, rollover=False)
+            return writer.volumes
+
+        with STAGES.stage('zip'):
+            if parallel_months:
+                months = {}
+                for file_path, arcname in entries:
+                    months.setdefault(arcname.split(os.sep)[0], []).append((file_path, arcname))
+                # DEFLATE y las copias del kernel liberan el GIL: un hilo por mes, hasta un núcleo cada uno
+                workers = max(1, min(len(months), os.cpu_count() or 1))
+                logging.info(f"Construyendo {len(months)} ZIP por mes, {workers} a la vez")
+                ordered = sorted(months, key=month_folder_key)
+                last = ordered[-1] if ordered else None
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='glosas-zip') as pool:
+                    futures = [pool.submit(write_volumes, months[month], manifest_entries if month == last else [])
+                               for month in ordered]
+                volumes = [volume for future in futures for volume in future.result()]
+            else:
+                volumes = write_volumes(entries, manifest_entries)
+        zip_paths = [path for path, _ in volumes]
+        if parallel_months:
+            write_archive_index(base_path, keyword, volumes)
 
-        logging.info(f"ZIP creado exitosamente: {zip_path}")
+        for file_path in manifest_files:
+            if os.path.exists(file_path) and not append_monthly:
+                with atomic_output(f"{base_path}.{os.path.basename(file_path)}") as tmp_path:
+                    shutil.copyfile(file_path, tmp_path)
+
+        logging.info(f"ZIP creado exitosamente: {', '.join(zip_paths)}")
 
         # Limpiar toda la estructura de carpetas temporales
         logging.info("Limpiando archivos y carpetas temporales...")
@@ -598,130 +2079,203 @@ def create_zip_file(downloaded_files, keyword):
         except Exception as e:
             logging.warning(f"No se pudo eliminar directorio temporal: {e}")
 
-        return zip_path
+        return zip_paths
 
     except Exception as e:
         logging.error(f"Error al crear archivo ZIP: {e}")
         raise Exception(f"Error al crear archivo ZIP: {str(e)}")
 
-def process_emails(remitente, keyword, fecha_desde=None, fecha_hasta=None, parent_window=None):
-    """Procesa correos del remitente y descarga archivos con la palabra clave en el nombre"""
+def build_query(remitente, fecha_desde=None, fecha_hasta=None):
+    """Construye la consulta de búsqueda de Gmail para el remitente y rango de fechas"""
+    query = f"from:{remitente} has:attachment"
+
+    # Agregar filtro de fechas si está disponible (hacer "hasta" inclusivo)
+    if fecha_desde and fecha_hasta:
+        # Sumar 1 día a fecha_hasta para hacerla inclusiva
+        hasta_date = datetime.strptime(fecha_hasta, "%Y/%m/%d")
+        hasta_inclusiva = (hasta_date + timedelta(days=1)).strftime("%Y/%m/%d")
+        query += f" after:{fecha_desde} before:{hasta_inclusiva}"
+        logging.info(f"Buscando correos desde {fecha_desde} hasta {fecha_hasta} (inclusivo)")
+
+    return query
+
+def preflight_count(gmail, query, state):
+    """Preconteo: lista solo los IDs y separa los que faltan por procesar.
+
+    Devuelve (todos los IDs, número sin procesar, {threadId: [IDs sin procesar]}).
+    """
+    message_ids = []
+    threads = {}
+    pages = 0
+    for page in list_message_pages(gmail, query):
+        for msg in page:
+            message_ids.append(msg['id'])
+            if msg['id'] not in state:
+                threads.setdefault(msg.get('threadId') or msg['id'], []).append(msg['id'])
+        pages += 1
+    new_count = sum(len(ids) for ids in threads.values())
+    logging.info(f"Preconteo: {len(message_ids)} mensajes, {new_count} sin procesar "
+                 f"en {len(threads)} conversaciones ({pages} páginas)")
+    return message_ids, new_count, threads
+
+def estimate_run(new_count, rates):
+    """Llamadas a la API, bytes y segundos estimados para new_count mensajes nuevos"""
+    attachments = new_count * rates['adjuntos_por_mensaje']
+    return {
+        'mensajes': new_count,
+        'adjuntos': round(attachments),
+        'llamadas': new_count + round(attachments),  # messages.get + attachments.get
+        'bytes': round(attachments * rates['bytes_por_adjunto']),
+        'segundos': new_count / rates['mensajes_por_segundo'],
+        'historico': rates['historico'],
+    }
+
+def format_estimate(total, estimate):
+    """Texto del preconteo para el log y el cuadro de confirmación"""
+    minutes, seconds = divmod(round(estimate['segundos']), 60)
+    hours, minutes = divmod(minutes, 60)
+    duration = f"{hours} h {minutes} min" if hours else (f"{minutes} min {seconds} s" if minutes else f"{seconds} s")
+    text = f"📬 Mensajes encontrados: {total}\n"
+    text += f"🆕 Sin procesar: {estimate['mensajes']} (ya procesados: {total - estimate['mensajes']})\n\n"
+    text += f"Estimación{'' if estimate['historico'] else ' (sin historial, valores aproximados)'}:\n"
+    text += f"   • Adjuntos: ~{estimate['adjuntos']}\n"
+    text += f"   • Llamadas a la API: ~{estimate['llamadas']}\n"
+    text += f"   • Descarga: ~{estimate['bytes'] / 1e6:.1f} MB\n"
+    text += f"   • Tiempo: ~{duration}"
+    return text
+
+def get_message_date(msg_data):
+    """Fecha del mensaje a partir de internalDate (milisegundos desde epoch)"""
+    internal_date = msg_data.get('internalDate')
+    if internal_date:
+        return datetime.fromtimestamp(int(internal_date) / 1000.0)
+    return datetime.now()
+
+def get_header(msg_data, name):
+    """Valor de un encabezado del mensaje (From, Subject...) o cadena vacía"""
+    for header in msg_data.get('payload', {}).get('headers', []):
+        if header.get('name', '').lower() == name.lower():
+            return header.get('value', '')
+    return ''
+
+def find_matching_parts(msg_data, keyword):
+    """Partes del mensaje cuyo nombre de archivo contiene la palabra clave"""
+    return list(iter_attachment_parts(msg_data.get('payload', {}), keyword))
+
+def process_emails(remitente, keyword, fecha_desde=None, fecha_hasta=None, parent_window=None,
+                   engine='auto', concurrency=DEFAULT_CONCURRENCY, archive_options=None,
+                   destination=None, s3_endpoint=None, extract_excel=None, search_index=None,
+                   layout='fecha', by_thread=False, adaptive_concurrency=True, fsync=True):
+    """Procesa correos del remitente y descarga archivos con la palabra clave en el nombre.
+
+    Sin destino los archivos se empaquetan en un ZIP en el escritorio; con destino
+    (carpeta local/sincronizada o s3://bucket/prefijo) se guardan directamente allí.
+    Con extract_excel (ruta de la base de datos) los Excel se extraen a SQLite al llegar,
+    y con search_index (ruta del índice) cada archivo se agrega al índice de búsqueda.
+    layout: 'fecha' (Año-Mes/Semana_N), 'prestador' o 'factura'. Con by_thread se obtiene
+    cada conversación con un solo threads.get en lugar de un messages.get por mensaje.
+    En el motor asíncrono concurrency es el techo de la ventana adaptativa (o un valor fijo
+    si adaptive_concurrency es False). En disco los archivos se escriben desde un hilo de E/S;
+    fsync=False omite la sincronización (más rápido, menos seguro ante un corte de luz).
+    """
     progress_window = None
+    credentials = None
+    cache = None
+    state = None
+    manifest = None
+    extractor = None
+    index = None
+    identifiers = None
+    writer = None
+    store = None
+    http = None
+    history = None
     try:
         logging.info(f"Iniciando procesamiento de correos de: {remitente}")
 
-        # Autenticación
-        creds = get_credentials()
-        gmail = build('gmail', 'v1', credentials=creds)
-
-        # Cargar IDs ya procesados
-        processed_ids = load_processed_ids()
+        # Autenticación: un único token compartido y refrescado en segundo plano
+        with STAGES.stage('autenticacion'):
+            credentials = CredentialManager(get_credentials()).start()
+
+        # Cargar IDs ya procesados para esta palabra clave y la caché de metadatos
+        state = ProcessedState(keyword)
+        previously_processed = len(state)
+        cache = MetadataCache()
+        sink = open_sink(destination, s3_endpoint)
+        recover_partial_outputs()
+        # Con destino externo el manifiesto se escribe aparte y se sube al terminar
+        manifest = RunManifest(tempfile.mkdtemp(prefix='glosas_manifiesto_') if destination else DOWNLOAD_DIR)
+        extractor = ExcelExtractor(extract_excel) if extract_excel else None
+        index = SearchIndex(search_index) if search_index else None
+        identifiers = IdentifierIndex()
+        writer = WriteBehind(sink, fsync) if sink.write_behind else None
+        # Al anexar a los ZIP mensuales, los nombres ya archivados cuentan como ocupados
+        archived = (ArchivedNames(archive_base_path(keyword))
+                    if not destination and (archive_options or {}).get('append_monthly') else None)
+        store = AttachmentStore(PathPlanner(sink, layout, archived), manifest, extractor, index, identifiers,
+                                writer)
+        CONNECTION_STATS.reset()
 
         # Construir query de búsqueda
-        query = f"from:{remitente} has:attachment"
-
-        # Agregar filtro de fechas si está disponible (hacer "hasta" inclusivo)
-        if fecha_desde and fecha_hasta:
-            # Sumar 1 día a fecha_hasta para hacerla inclusiva
-            hasta_date = datetime.strptime(fecha_hasta, "%Y/%m/%d")
-            hasta_inclusiva = (hasta_date + timedelta(days=1)).strftime("%Y/%m/%d")
-            query += f" after:{fecha_desde} before:{hasta_inclusiva}"
-            logging.info(f"Buscando correos desde {fecha_desde} hasta {fecha_hasta} (inclusivo)")
-
+        query = build_query(remitente, fecha_desde, fecha_hasta)
         logging.info(f"Query de búsqueda: {query}")
 
-        # Primera solicitud a la API para contar mensajes
-        response = gmail.users().messages().list(userId='me', q=query, maxResults=500).execute()
-
-        # Contar total de mensajes para la barra de progreso
-        messages_first_page = response.get('messages', [])
-        total_messages_estimate = len(messages_first_page)
-
         # Crear ventana de progreso
         if parent_window:
             progress_window = ProgressWindow(parent_window)
             progress_window.update_status("Contando mensajes...")
             progress_window.update_progress(0, 100)
 
-        new_processed = set()
-        downloaded_files = []
-        total_messages = 0
-        processed_count = 0
-
-        # Procesar todos los mensajes
-        while True:
-            messages = response.get('messages', [])
-            total_messages += len(messages)
-            logging.info(f"Procesando {len(messages)} mensajes...")
-
-            for msg in messages:
-                msg_id = msg['id']
-                processed_count += 1
-
-                # Actualizar progreso
-                if progress_window:
-                    progress_window.update_status(f"Procesando mensajes ({processed_count}/{total_messages})...")
-                    progress_window.update_progress(processed_count, total_messages)
-
-                # Saltar si ya fue procesado
-                if msg_id in processed_ids:
-                    logging.debug(f"Mensaje {msg_id} ya procesado, saltando...")
-                    continue
-
-                # Obtener detalles del mensaje
-                msg_data = gmail.users().messages().get(userId='me', id=msg_id).execute()
-
-                # Extraer fecha del mensaje (en milisegundos desde epoch)
-                internal_date = msg_data.get('internalDate')
-                if internal_date:
-                    msg_date = datetime.fromtimestamp(int(internal_date) / 1000.0)
-                else:
-                    msg_date = datetime.now()
-
-                parts = get_parts(msg_data.get('payload', {}))
-
-                # Buscar archivos con la palabra clave en el nombre
-                for part in parts:
-                    filename = part.get('filename', '')
-                    if filename and keyword in filename.upper():
-                        logging.info(f"Archivo encontrado: {filename}")
-
-                        # Actualizar UI con el archivo actual
-                        if progress_window:
-                            progress_window.update_current_file(filename)
-
-                        # Descargar con la fecha del mensaje
-                        path = download_attachment(gmail, msg_id, part, msg_date)
-                        if path:
-                            downloaded_files.append(path)
-                            logging.info(f"Descargado: {filename}")
-
-                            # Actualizar contador de archivos
-                            if progress_window:
-                                progress_window.update_files(len(downloaded_files))
-
-                new_processed.add(msg_id)
-
-                # Pausa ligera para evitar límites de la API
-                time.sleep(0.3)
-
-            # Guardar progreso después de cada página
-            save_processed_ids(processed_ids.union(new_processed))
-
-            # Verificar si hay más páginas
-            if 'nextPageToken' in response:
-                logging.info("Obteniendo siguiente página de resultados...")
-                if progress_window:
-                    progress_window.update_status("Obteniendo más mensajes...")
-
-                response = gmail.users().messages().list(
-                    userId='me',
-                    q=query,
-                    pageToken=response['nextPageToken'],
-                    maxResults=500
-                ).execute()
-            else:
-                break
+        if engine == 'auto':
+            engine = 'async' if aiohttp else 'sync'
+        if engine == 'async' and not aiohttp:
+            logging.warning("aiohttp no está instalado, se usará el motor secuencial")
+            engine = 'sync'
+
+        # Preconteo solo con IDs: estimación antes de confirmar y total real para el progreso
+        gmail, http = build_gmail_service(credentials, pool_size=concurrency)
+        with STAGES.stage('preconteo'):
+            message_ids, new_count, threads = preflight_count(gmail, query, state)
+        history = RunHistory()
+        estimate_text = format_estimate(len(message_ids), estimate_run(new_count, history.rates(engine)))
+        logging.info(" | ".join(line.strip() for line in estimate_text.splitlines() if line.strip()))
+        # La ventana de progreso está siempre al frente: el diálogo debe ser hijo suyo para no quedar oculto
+        if parent_window and new_count and not messagebox.askyesno(
+                "Confirmar descarga", f"{estimate_text}\n\n¿Deseas iniciar la descarga?",
+                parent=progress_window.window if progress_window else parent_window):
+            logging.info("Usuario canceló después del preconteo")
+            if progress_window:
+                progress_window.close()
+            return
+        if progress_window:
+            progress_window.update_progress(0, len(message_ids))
+
+        start = time.perf_counter()
+        calls_before = CONNECTION_STATS.total_calls()
+        if engine == 'async':
+            logging.info(f"Motor asíncrono con {'hasta ' if adaptive_concurrency else ''}"
+                         f"{concurrency} solicitudes simultáneas")
+            downloaded_files, total_messages = asyncio.run(
+                run_async_engine(credentials, query, keyword, state, progress_window, concurrency, cache, store,
+                                 message_ids, threads if by_thread else None, adaptive_concurrency)
+            )
+        elif by_thread:
+            downloaded_files, total_messages = process_threads_serial(
+                gmail, keyword, state, threads, len(message_ids), progress_window, cache, store
+            )
+        else:
+            downloaded_files, total_messages = process_messages_serial(
+                gmail, query, keyword, state, progress_window, cache, store, message_ids
+            )
+        http.close()
+        http = None
+        if writer:
+            writer.close()
+            writer = None
+        # Lo que el hilo de E/S no pudo escribir no cuenta como descargado
+        downloaded_files = [path for path in downloaded_files if path not in store.failed_locations]
+        history.record(keyword, engine, new_count, len(downloaded_files), manifest.bytes,
+                       time.perf_counter() - start, CONNECTION_STATS.total_calls() - calls_before)
 
         # Cerrar ventana de progreso
         if progress_window:
@@ -729,16 +2283,41 @@ def process_emails(remitente, keyword, fecha_desde=None, fecha_hasta=None, paren
             progress_window.update_progress(100, 100)
 
         logging.info(f"Procesamiento completado: {total_messages} mensajes revisados, {len(downloaded_files)} archivos descargados")
+        logging.info(CONNECTION_STATS.summary())
+        for line in STAGES.summary_lines():
+            logging.debug(line)
 
+        manifest.close()
+        if extractor:
+            if progress_window:
+                progress_window.update_status("Extrayendo Excel...")
+            extractor.close()
+            extractor = None
+
+        if destination:
+            if progress_window:
+                progress_window.close()
+            if downloaded_files:
+                upload_run_manifest(manifest, sink)
+            show_destination_summary(sink, downloaded_files, total_messages, previously_processed, keyword)
         # Crear archivo ZIP con estructura de carpetas
-        if downloaded_files:
-            zip_path = create_zip_file(downloaded_files, keyword)
+        elif downloaded_files:
+            if index:
+                index.wait()
+            zip_paths = create_zip_file(downloaded_files, keyword, checksums=store.checksums,
+                                        **(archive_options or {}))
+            if index:
+                index.relocate(zip_paths)
+            identifiers.relocate(zip_paths)
             if progress_window:
                 progress_window.close()
 
-            if zip_path:
+            if zip_paths:
                 mensaje = f"✅ Proceso completado exitosamente\n\n"
-                mensaje += f"📦 Archivo: {os.path.basename(zip_path)}\n"
+                if len(zip_paths) == 1:
+                    mensaje += f"📦 Archivo: {os.path.basename(zip_paths[0])}\n"
+                else:
+                    mensaje += f"📦 Volúmenes: {len(zip_paths)} (desde {os.path.basename(zip_paths[0])})\n"
                 mensaje += f"📁 Ubicación: ESCRITORIO\n"
                 mensaje += f"📂 Estructura: Carpetas organizadas por mes y semana\n\n"
                 mensaje += f"Total de archivos descargados: {len(downloaded_files)}\n"
@@ -751,7 +2330,7 @@ def process_emails(remitente, keyword, fecha_desde=None, fecha_hasta=None, paren
 
             mensaje = f"No se encontraron archivos nuevos con {keyword} para descargar.\n\n"
             mensaje += f"Mensajes revisados: {total_messages}\n"
-            mensaje += f"Ya procesados previamente: {len(processed_ids)}"
+            mensaje += f"Ya procesados previamente: {previously_processed}"
             messagebox.showwarning("Sin Resultados", mensaje)
             logging.info("No se encontraron archivos nuevos")
 
@@ -761,13 +2340,2260 @@ def process_emails(remitente, keyword, fecha_desde=None, fecha_hasta=None, paren
         logging.error(f"Error en process_emails: {str(e)}")
         logging.error(traceback.format_exc())
         raise Exception(f"Error al procesar correos: {str(e)}")
+    finally:
+        if writer:
+            writer.close()
+        if http:
+            http.close()
+        if history:
+            history.close()
+        if credentials:
+            credentials.stop()
+        if extractor:
+            extractor.close()
+        if index:
+            index.close()
+        if identifiers:
+            identifiers.close()
+        if cache:
+            cache.close()
+        if state:
+            state.close(store.flush if store else None)
+        if manifest:
+            manifest.close()
+            if destination:
+                shutil.rmtree(manifest.directory, ignore_errors=True)
+
+def upload_run_manifest(manifest, sink):
+    """Sube el manifiesto de la ejecución al destino con la marca de tiempo en el nombre"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # En modo vigilancia puede haber varios ciclos en el mismo segundo: no pisar el anterior
+    suffix, n = timestamp, 1
+    while sink.exists(f"{os.path.splitext(MANIFEST_CSV)[0]}_{suffix}.csv"):
+        n += 1
+        suffix = f"{timestamp}_{n}"
+    for local_path in (manifest.csv_path, manifest.jsonl_path):
+        if os.path.exists(local_path):
+            base, ext = os.path.splitext(os.path.basename(local_path))
+            with STAGES.stage(sink.stage_name):
+                location = sink.put_file(f"{base}_{suffix}{ext}", local_path)
+            logging.info(f"Manifiesto guardado en: {location}")
+
+def show_destination_summary(sink, downloaded_files, total_messages, previously_processed, keyword):
+    """Resumen final cuando los archivos se guardan directamente en un destino"""
+    if downloaded_files:
+        mensaje = f"✅ Proceso completado exitosamente\n\n"
+        mensaje += f"📁 Destino: {sink.describe()}\n"
+        mensaje += f"📂 Estructura: Carpetas organizadas por mes y semana\n\n"
+        mensaje += f"Total de archivos descargados: {len(downloaded_files)}\n"
+        mensaje += f"Mensajes revisados: {total_messages}"
+        messagebox.showinfo("Descarga Completada", mensaje)
+        logging.info(f"Proceso completado exitosamente en {sink.describe()}")
+    else:
+        mensaje = f"No se encontraron archivos nuevos con {keyword} para descargar.\n\n"
+        mensaje += f"Mensajes revisados: {total_messages}\n"
+        mensaje += f"Ya procesados previamente: {previously_processed}"
+        messagebox.showwarning("Sin Resultados", mensaje)
+        logging.info("No se encontraron archivos nuevos")
+
+def list_message_pages(gmail, query):
+    """Páginas del listado con solo ID y conversación de cada mensaje (fields reduce la respuesta)"""
+    page_token = None
+    while True:
+        with STAGES.stage('api.list'):
+            response = gmail.users().messages().list(
+                userId='me',
+                q=query,
+                pageToken=page_token,
+                maxResults=500,
+                fields='messages(id,threadId),nextPageToken'
+            ).execute()
+        yield response.get('messages', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+        logging.info("Obteniendo siguiente página de resultados...")
+
+def process_messages_serial(gmail, query, keyword, state, progress_window=None, cache=None, store=None,
+                            message_ids=None):
+    """Motor secuencial: lista (o usa los IDs del preconteo), obtiene y descarga mensaje por mensaje"""
+    if message_ids is not None:
+        pages = (message_ids[i:i + 500] for i in range(0, len(message_ids), 500))
+        total_messages = len(message_ids)
+    else:
+        pages = ([msg['id'] for msg in page] for page in list_message_pages(gmail, query))
+        total_messages = 0
+
+    downloaded_files = []
+    processed_count = 0
+
+    # Procesar todos los mensajes
+    for page in pages:
+        if message_ids is None:
+            total_messages += len(page)
+        logging.info(f"Procesando {len(page)} mensajes...")
+
+        for msg_id in page:
+            processed_count += 1
+
+            # Actualizar progreso
+            if progress_window:
+                progress_window.update_status(f"Procesando mensajes ({processed_count}/{total_messages})...")
+                progress_window.update_progress(processed_count, total_messages)
+
+            # Saltar si ya fue procesado para esta palabra clave
+            if msg_id in state:
+                logging.debug(f"Mensaje {msg_id} ya procesado, saltando...")
+                continue
+
+            msg_data = cache.get(msg_id) if cache else None
+            from_api = msg_data is None
+            if from_api:
+                msg_data = download_message(gmail, msg_id, cache)
+            process_message(gmail, msg_id, keyword, state, cache, store, downloaded_files, progress_window, msg_data)
+
+            # Pausa ligera para evitar límites de la API (solo tras una consulta real, no con la caché)
+            if from_api:
+                with STAGES.stage('pausa'):
+                    time.sleep(0.3)
+
+        # Guardar progreso después de cada página (con los archivos ya escritos)
+        with STAGES.stage('estado'):
+            state.save(store.flush if store else None)
+
+    return downloaded_files, total_messages
+
+def fetch_message(gmail, msg_id, cache=None):
+    """Detalles del mensaje, primero desde la caché local"""
+    msg_data = cache.get(msg_id) if cache else None
+    return msg_data or download_message(gmail, msg_id, cache)
+
+def download_message(gmail, msg_id, cache=None):
+    """messages.get a la API; la respuesta queda en la caché"""
+    with STAGES.stage('api.get'):
+        msg_data = gmail.users().messages().get(userId='me', id=msg_id).execute()
+    if cache:
+        cache.put(msg_data)
+    return msg_data
+
+def process_message(gmail, msg_id, keyword, state, cache, store, downloaded_files,
+                    progress_window=None, msg_data=None, thread_stats=None, seen=None):
+    """Descarga los adjuntos con la palabra clave de un mensaje y lo marca como procesado.
+
+    En modo por conversaciones `seen` guarda los adjuntos ya vistos en el hilo para omitir repetidos.
+    """
+    msg_data = msg_data or fetch_message(gmail, msg_id, cache)
+    msg_date = get_message_date(msg_data)
+    sender = get_header(msg_data, 'From')
+    subject = get_header(msg_data, 'Subject')
+
+    # Buscar archivos con la palabra clave en el nombre
+    for part in find_matching_parts(msg_data, keyword):
+        filename = part['filename']
+        if seen is not None and thread_stats.is_duplicate(part, seen):
+            continue
+        logging.info(f"Archivo encontrado: {filename}")
+
+        # Actualizar UI con el archivo actual
+        if progress_window:
+            progress_window.update_current_file(filename)
+
+        # Descargar con la fecha del mensaje
+        path = download_attachment(gmail, msg_id, part, msg_date, store, sender, subject)
+        if path:
+            downloaded_files.append(path)
+            logging.info(f"Descargado: {filename}")
+
+            # Actualizar contador de archivos
+            if progress_window:
+                progress_window.update_files(len(downloaded_files))
+
+    state.add(msg_id)
+
+class ThreadFetchStats:
+    """Llamadas del modo por conversaciones frente a las que habría hecho el modo por mensaje"""
+    def __init__(self):
+        self.messages = 0     # Mensajes nuevos revisados
+        self.uncached = 0     # De ellos, los que no estaban en la caché (un messages.get cada uno)
+        self.threads = 0      # threads.get realizados
+        self.attachments = 0  # attachments.get realizados
+        self.duplicates = 0   # Adjuntos repetidos dentro de la conversación que no se descargaron
+
+    def is_duplicate(self, part, seen):
+        """Mismo nombre y tamaño ya visto en el hilo (p. ej. una respuesta que reenvía el adjunto)"""
+        key = (part['filename'], part.get('body', {}).get('size'))
+        if key in seen:
+            self.duplicates += 1
+            logging.info(f"Adjunto repetido en la conversación, se omite: {part['filename']}")
+            return True
+        seen.add(key)
+        self.attachments += 1
+        return False
+
+    def summary(self):
+        per_message = self.uncached + self.attachments + self.duplicates
+        per_thread = self.threads + self.attachments
+        saved = per_message - per_thread
+        ratio = saved / per_message * 100 if per_message else 0.0
+        return (f"Modo por conversaciones: {self.messages} mensajes en {self.threads} threads.get, "
+                f"{self.duplicates} adjuntos repetidos omitidos; {per_thread} llamadas frente a "
+                f"{per_message} por mensaje ({saved} ahorradas, {ratio:.1f}%)")
+
+def fetch_thread_messages(gmail, thread_id, msg_ids, cache, thread_stats):
+    """Los mensajes pedidos de una conversación con un solo threads.get (o desde la caché)"""
+    cached = {msg_id: cache.get(msg_id) for msg_id in msg_ids} if cache else {}
+    missing = [msg_id for msg_id in msg_ids if cached.get(msg_id) is None]
+    thread_stats.messages += len(msg_ids)
+    thread_stats.uncached += len(missing)
+    if not missing:
+        return [cached[msg_id] for msg_id in msg_ids]
+
+    with STAGES.stage('api.thread'):
+        thread = gmail.users().threads().get(userId='me', id=thread_id).execute()
+    thread_stats.threads += 1
+    # El hilo trae también respuestas propias y otros remitentes: solo los listados por la búsqueda
+    fetched = {msg['id']: msg for msg in thread.get('messages', [])}
+    messages = []
+    for msg_id in msg_ids:
+        msg_data = cached.get(msg_id) or fetched.get(msg_id)
+        if msg_data is None:
+            continue  # Borrado entre el listado y la descarga
+        if cache and msg_id in missing:
+            cache.put(msg_data)
+        messages.append(msg_data)
+    return messages
+
+def process_threads_serial(gmail, keyword, state, threads, total_messages, progress_window=None,
+                           cache=None, store=None):
+    """Motor secuencial por conversaciones: un threads.get por hilo con mensajes nuevos"""
+    downloaded_files = []
+    thread_stats = ThreadFetchStats()
+    processed_count = total_messages - sum(len(msg_ids) for msg_ids in threads.values())
+
+    for thread_id, msg_ids in threads.items():
+        seen = set()
+        threads_before = thread_stats.threads
+        for msg_data in fetch_thread_messages(gmail, thread_id, msg_ids, cache, thread_stats):
+            processed_count += 1
+            if progress_window:
+                progress_window.update_status(f"Procesando mensajes ({processed_count}/{total_messages})...")
+                progress_window.update_progress(processed_count, total_messages)
+            process_message(gmail, msg_data['id'], keyword, state, cache, store, downloaded_files,
+                            progress_window, msg_data, thread_stats, seen)
+
+        # Hilo servido entero desde la caché: sin consulta a la API no hace falta pausa
+        if thread_stats.threads == threads_before:
+            continue
+        # Pausa ligera para evitar límites de la API
+        with STAGES.stage('pausa'):
+            time.sleep(0.3)
+        if thread_stats.threads % 100 == 0:
+            with STAGES.stage('estado'):
+                state.save(store.flush if store else None)
+
+    with STAGES.stage('estado'):
+        state.save(store.flush if store else None)
+    if thread_stats.messages:
+        logging.info(thread_stats.summary())
+    return downloaded_files, total_messages
+
+# ============================
+# DESTINOS DE SALIDA
+# ============================
+class LocalDirectorySink:
+    """Destino en una carpeta local o sincronizada (Google Drive para escritorio, OneDrive...)"""
+    stage_name = 'disco'
+    parallelism = 1
+    # Admite escritura por lotes desde el hilo de E/S (WriteBehind)
+    write_behind = True
+
+    def __init__(self, root):
+        self.root = root
+        # Carpetas ya creadas en esta ejecución: makedirs una sola vez por carpeta
+        self._dirs = set()
+
+    def _path(self, relpath):
+        return os.path.join(self.root, *relpath.split('/'))
+
+    def _ensure_dir(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(directory)
+
+    def exists(self, relpath):
+        return os.path.exists(self._path(relpath))
+
+    def location(self, relpath):
+        return self._path(relpath)
+
+    def listdir(self, folder):
+        """Nombres de archivo que ya hay en la carpeta (vacío si no existe), sin los temporales huérfanos"""
+        directory = self._path(folder)
+        try:
+            names = set(os.listdir(directory))
+        except FileNotFoundError:
+            return set()
+        # Solo se limpian las carpetas en las que escribe esta ejecución, no todo el destino
+        return names - remove_stale_partials(directory, names)
+
+    def put(self, relpath, data):
+        # Temporal + renombrado: el cliente de sincronización nunca sube un archivo a medias
+        path = self._path(relpath)
+        self._ensure_dir(path)
+        atomic_write(path, data)
+        return path
+
+    def write_batch(self, items, fsync=True):
+        """Escribe un lote [(relpath, datos)] carpeta por carpeta; devuelve las rutas relativas que fallaron.
+
+        Primero se escriben todos los temporales y después se sincronizan, así el sistema de archivos
+        vacía el lote completo de una vez; los renombres van al final y cada carpeta se sincroniza una sola vez.
+        """
+        opened = []
+        failed = set()
+
+        def discard(relpath, f, tmp_path, error):
+            logging.error(f"Error al escribir {relpath}: {error}")
+            failed.add(relpath)
+            if f and not f.closed:
+                f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        for relpath, data in sorted(items, key=lambda item: item[0]):
+            path = self._path(relpath)
+            tmp_path = partial_path(path)
+            f = None
+            try:
+                self._ensure_dir(path)
+                f = open(tmp_path, 'wb')
+                f.write(data)
+                f.flush()
+                opened.append((relpath, f, tmp_path, path))
+            except OSError as e:
+                discard(relpath, f, tmp_path, e)
+        written = []
+        for relpath, f, tmp_path, path in opened:
+            try:
+                if fsync:
+                    os.fsync(f.fileno())
+                f.close()
+                os.replace(tmp_path, path)
+                written.append(path)
+            except OSError as e:
+                discard(relpath, f, tmp_path, e)
+        if fsync and os.name != 'nt':
+            # Los renombres quedan en disco al sincronizar cada carpeta del lote
+            for directory in {os.path.dirname(path) for path in written}:
+                try:
+                    dir_fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(dir_fd)
+                    finally:
+                        os.close(dir_fd)
+                except OSError as e:
+                    logging.warning(f"No se pudo sincronizar la carpeta {directory}: {e}")
+        return failed
+
+    def put_file(self, relpath, local_path):
+        path = self._path(relpath)
+        self._ensure_dir(path)
+        with atomic_output(path) as tmp_path:
+            shutil.copyfile(local_path, tmp_path)
+        return path
+
+    def describe(self):
+        return self.root
+
+class S3Sink:
+    """Destino S3 compatible (AWS, MinIO...) con subidas multiparte y partes en paralelo"""
+    stage_name = 's3'
+    parallelism = S3_UPLOAD_WORKERS
+    write_behind = False
+
+    def __init__(self, url, endpoint_url=None):
+        if boto3 is None:
+            raise Exception("Para usar un destino s3:// instala boto3 (pip install boto3)")
+        self.bucket, _, prefix = url[len('s3://'):].partition('/')
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        # upload_fileobj divide en partes de S3_PART_SIZE y sube S3_PART_WORKERS a la vez;
+        # los archivos menores que una parte van en un único PUT
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_PART_SIZE,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_PART_WORKERS
+        )
+
+    def _key(self, relpath):
+        return f"{self.prefix}/{relpath}" if self.prefix else relpath
+
+    def exists(self, relpath):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(relpath))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def listdir(self, folder):
+        """Nombres de los objetos que ya hay bajo el prefijo de la carpeta"""
+        prefix = self._key(folder) + '/'
+        names = set()
+        for page in self.client.get_paginator('list_objects_v2').paginate(
+                Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            names.update(obj['Key'][len(prefix):] for obj in page.get('Contents', []))
+        return names
+
+    def location(self, relpath):
+        return f"s3://{self.bucket}/{self._key(relpath)}"
+
+    def put(self, relpath, data):
+        key = self._key(relpath)
+        self.client.upload_fileobj(io.BytesIO(data), self.bucket, key, Config=self.transfer)
+        return f"s3://{self.bucket}/{key}"
+
+    def put_file(self, relpath, local_path):
+        key = self._key(relpath)
+        self.client.upload_file(local_path, self.bucket, key, Config=self.transfer)
+        return f"s3://{self.bucket}/{key}"
+
+    def describe(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+class WriteBehind:
+    """Hilo de E/S que escribe los adjuntos por lotes mientras la red sigue descargando.
+
+    Lo pendiente nunca supera budget_bytes: si el disco va más lento que la red, quien
+    descarga espera en submit en lugar de acumular memoria.
+    """
+    def __init__(self, sink, fsync=True, budget_bytes=WRITE_BEHIND_MB * 1024 * 1024):
+        self.sink = sink
+        self.fsync = fsync
+        self.budget_bytes = budget_bytes
+        self.batches = 0
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self._queue = []
+        self._pending_bytes = 0  # en cola o escribiéndose
+        self._flushing = 0  # hilos esperando en flush: el lote se escribe sin esperar a que crezca
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='glosas-escritura', daemon=True)
+        self._thread.start()
+
+    def submit(self, relpath, data, on_written=None):
+        """Encola el archivo; on_written(ok) se llama desde el hilo de E/S cuando ya está en el destino o falló"""
+        with self._cond:
+            while self._pending_bytes and self._pending_bytes + len(data) > self.budget_bytes:
+                self._cond.wait()
+            self._queue.append((relpath, data, on_written))
+            self._pending_bytes += len(data)
+            self._cond.notify_all()
+
+    def _next_batch(self):
+        """Espera a que haya trabajo y devuelve el siguiente lote (None al cerrar sin pendientes)"""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            # Dar tiempo a que el lote crezca, salvo que alguien espere en flush/close
+            # o que la memoria pendiente ya frene a quien descarga
+            deadline = time.monotonic() + WRITE_BEHIND_LINGER
+            while (len(self._queue) < WRITE_BEHIND_BATCH_FILES and not self._closed and not self._flushing
+                   and self._pending_bytes * 2 < self.budget_bytes):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._queue[:WRITE_BEHIND_BATCH_FILES]
+            self._queue = self._queue[WRITE_BEHIND_BATCH_FILES:]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            size = sum(len(data) for _, data, _ in batch)
+            try:
+                with STAGES.stage(self.sink.stage_name):
+                    failed = self.sink.write_batch([(relpath, data) for relpath, data, _ in batch], self.fsync)
+            except Exception as e:
+                logging.error(f"Error al escribir un lote de {len(batch)} archivos: {e}")
+                failed = {relpath for relpath, _, _ in batch}
+            # Antes de liberar el lote: cuando flush vuelve, todo quedó registrado
+            for relpath, _, on_written in batch:
+                if on_written:
+                    try:
+                        on_written(relpath not in failed)
+                    except Exception as e:
+                        logging.error(f"Error al registrar {relpath}: {e}")
+            with self._cond:
+                self._pending_bytes -= size
+                self.batches += 1
+                self.files += len(batch) - len(failed)
+                self.bytes += size
+                self.failed += len(failed)
+                self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending_bytes:
+                    self._cond.wait()
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self.batches:
+            logging.info(f"Escritura en segundo plano: {self.files} archivos en {self.batches} lotes "
+                         f"({self.bytes / 1024 / 1024:.1f} MB, fsync {'sí' if self.fsync else 'no'})"
+                         + (f", {self.failed} con error" if self.failed else ""))
+
+def open_sink(destination=None, s3_endpoint=None):
+    """Destino según --destino: s3://bucket/prefijo, una carpeta, o DOWNLOAD_DIR para el ZIP"""
+    if not destination:
+        return LocalDirectorySink(DOWNLOAD_DIR)
+    if destination.startswith('s3://'):
+        return S3Sink(destination, s3_endpoint)
+    return LocalDirectorySink(os.path.abspath(os.path.expanduser(destination)))
+
+# ============================
+# EXTRACCIÓN DE EXCEL
+# ============================
+def normalize_column(name, position):
+    """Nombre de columna normalizado: minúsculas, sin tildes y con guiones bajos"""
+    text = unicodedata.normalize('NFKD', str(name or '')).encode('ascii', 'ignore').decode()
+    text = re.sub(r'[^a-z0-9]+', '_', text.lower()).strip('_')
+    return text or f"columna_{position + 1}"
+
+def excel_value(value):
+    """Valor de celda serializable en JSON"""
+    if isinstance(value, datetime):
+        return value.isoformat(timespec='seconds')
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        return value.strip() or None
+    return value
+
+def sheet_to_rows(rows):
+    """Convierte las filas de una hoja en (número de fila, JSON) usando la primera fila de encabezado"""
+    header = None
+    for row_number, values in enumerate(rows, start=1):
+        values = [excel_value(v) for v in values]
+        filled = [v for v in values if v is not None]
+        if header is None:
+            # Encabezado: primera fila con al menos dos celdas y mayoría de texto
+            if len(filled) >= 2 and sum(isinstance(v, str) for v in filled) * 2 >= len(filled):
+                header = []
+                for position, name in enumerate(values):
+                    column = base = normalize_column(name, position)
+                    suffix = 1
+                    while column in header:
+                        suffix += 1
+                        column = f"{base}_{suffix}"
+                    header.append(column)
+            elif row_number >= EXCEL_HEADER_SCAN_ROWS:
+                return
+            continue
+        if not filled:
+            continue
+        columns = header + [f"columna_{i + 1}" for i in range(len(header), len(values))]
+        data = {column: value for column, value in zip(columns, values) if value is not None}
+        yield row_number, json.dumps(data, ensure_ascii=False, default=str)
+
+def parse_workbook(file_data, filename):
+    """En un proceso del pool: lee el libro en modo streaming y devuelve (hojas, [(hoja, fila, datos)])"""
+    parsed = []
+    if filename.lower().endswith('.xls'):
+        if xlrd is None:
+            raise Exception("xlrd no está instalado (necesario para .xls)")
+        # on_demand: cada hoja se carga al pedirla y se libera al terminar
+        book = xlrd.open_workbook(file_contents=file_data, on_demand=True)
+        try:
+            sheet_names = book.sheet_names()
+            for sheet_name in sheet_names:
+                sheet = book.sheet_by_name(sheet_name)
+                rows = (
+                    [xlrd.xldate_as_datetime(cell.value, book.datemode)
+                     if cell.ctype == xlrd.XL_CELL_DATE else cell.value
+                     for cell in sheet.row(i)]
+                    for i in range(sheet.nrows)
+                )
+                parsed.extend((sheet_name, n, data) for n, data in sheet_to_rows(rows))
+                book.unload_sheet(sheet_name)
+        finally:
+            book.release_resources()
+    else:
+        if openpyxl is None:
+            raise Exception("openpyxl no está instalado (necesario para .xlsx)")
+        # read_only: las filas se leen en streaming sin cargar el libro completo
+        book = openpyxl.load_workbook(io.BytesIO(file_data), read_only=True, data_only=True)
+        try:
+            sheet_names = book.sheetnames
+            for sheet in book.worksheets:
+                rows = sheet.iter_rows(values_only=True)
+                parsed.extend((sheet.title, n, data) for n, data in sheet_to_rows(rows))
+        finally:
+            book.close()
+    return len(sheet_names), parsed
+
+class ExcelExtractor:
+    """Extrae las filas de los Excel descargados a SQLite en un pool de procesos, a medida que llegan"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS libros (
+            id INTEGER PRIMARY KEY,
+            sha256 TEXT NOT NULL UNIQUE,
+            nombre_original TEXT NOT NULL,
+            ubicacion TEXT,
+            id_mensaje TEXT,
+            id_adjunto TEXT,
+            remitente TEXT,
+            fecha_mensaje TEXT,
+            hojas INTEGER,
+            filas INTEGER,
+            error TEXT,
+            extraido TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS filas_glosa (
+            libro_id INTEGER NOT NULL REFERENCES libros(id),
+            hoja TEXT NOT NULL,
+            fila INTEGER NOT NULL,
+            datos TEXT NOT NULL,
+            PRIMARY KEY (libro_id, hoja, fila)
+        ) WITHOUT ROWID;
+        CREATE VIEW IF NOT EXISTS glosas AS
+            SELECT l.nombre_original, l.remitente, l.fecha_mensaje, l.id_mensaje, l.ubicacion,
+                   f.hoja, f.fila, f.datos
+            FROM filas_glosa f JOIN libros l ON l.id = f.libro_id;
+    """
+
+    def __init__(self, path=EXCEL_DB, workers=None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 2
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._known = {row[0] for row in self._conn.execute("SELECT sha256 FROM libros")}
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        # Libros en vuelo limitados: la descarga no acumula Excel pendientes en memoria
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self.books = 0
+        self.rows = 0
+        self.errors = 0
+
+    @staticmethod
+    def handles(filename):
+        return filename.lower().endswith(EXCEL_EXTENSIONS)
+
+    def submit(self, file_data, filename, location, msg_id=None, att_id=None, sender=None, msg_date=None,
+               digest=None):
+        if not self.handles(filename):
+            return
+        digest = digest or hashlib.sha256(file_data).hexdigest()
+        with self._lock:
+            if digest in self._known:
+                logging.debug(f"Excel ya extraído anteriormente: {filename}")
+                return
+            self._known.add(digest)
+        provenance = {
+            'sha256': digest,
+            'nombre_original': filename,
+            'ubicacion': location,
+            'id_mensaje': msg_id,
+            'id_adjunto': att_id,
+            'remitente': sender,
+            'fecha_mensaje': msg_date.isoformat(timespec='seconds') if msg_date else None,
+        }
+        self._slots.acquire()
+        future = self._pool.submit(parse_workbook, file_data, filename)
+        future.add_done_callback(lambda f: self._store(f, provenance))
+
+    def _store(self, future, provenance):
+        """Guarda el resultado de un libro (o su error) con la procedencia del mensaje"""
+        try:
+            sheets, parsed, error = 0, [], None
+            try:
+                sheets, parsed = future.result()
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                logging.warning(f"No se pudo extraer {provenance['nombre_original']}: {error}")
+            with self._lock, self._conn:
+                cursor = self._conn.execute(
+                    "INSERT INTO libros (sha256, nombre_original, ubicacion, id_mensaje, id_adjunto, "
+                    "remitente, fecha_mensaje, hojas, filas, error, extraido) "
+                    "VALUES (:sha256, :nombre_original, :ubicacion, :id_mensaje, :id_adjunto, "
+                    ":remitente, :fecha_mensaje, :hojas, :filas, :error, :extraido)",
+                    dict(provenance, hojas=sheets, filas=len(parsed), error=error,
+                         extraido=datetime.now().isoformat(timespec='seconds'))
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO filas_glosa VALUES (?, ?, ?, ?)",
+                    ((cursor.lastrowid, sheet, row, data) for sheet, row, data in parsed)
+                )
+                self.books += 1
+                self.rows += len(parsed)
+                self.errors += error is not None
+        except Exception as e:
+            logging.error(f"Error al guardar la extracción de {provenance['nombre_original']}: {e}")
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Espera a los libros pendientes y cierra el pool y la base de datos"""
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+        logging.info(f"Extracción de Excel: {self.books} libros, {self.rows} filas, "
+                     f"{self.errors} con error -> {self.path}")
+
+# ============================
+# ÍNDICE DE BÚSQUEDA
+# ============================
+def extract_text(file_data, filename):
+    """En un proceso del pool: texto de un PDF o Excel para el índice (vacío si no aplica)"""
+    lower = filename.lower()
+    if lower.endswith('.pdf'):
+        if pypdf is None:
+            return ''
+        reader = pypdf.PdfReader(io.BytesIO(file_data))
+        text = "\n".join(page.extract_text() or '' for page in reader.pages)
+    elif lower.endswith(EXCEL_EXTENSIONS):
+        _, rows = parse_workbook(file_data, filename)
+        text = "\n".join(" ".join(str(v) for v in json.loads(data).values()) for _, _, data in rows)
+    else:
+        return ''
+    return text[:SEARCH_MAX_TEXT]
+
+def fts_query(text):
+    """Consulta FTS5 con cada término como prefijo (760010379901_2005 -> "760010379901"* "2005"*)"""
+    terms = re.findall(r'[^\W_]+', text)
+    return " ".join(f'"{term}"*' for term in terms)
+
+class SearchIndex:
+    """Índice de texto completo (SQLite FTS5) de nombres, asuntos y texto de PDF/Excel"""
+    SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS documentos USING fts5(
+            nombre, asunto, contenido,
+            ubicacion UNINDEXED, ruta UNINDEXED, id_mensaje UNINDEXED, remitente UNINDEXED,
+            fecha_mensaje UNINDEXED, sha256 UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+    """
+
+    def __init__(self, path=SEARCH_DB, workers=None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 2
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._known = {row[0] for row in self._conn.execute("SELECT sha256 FROM documentos")}
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._pending = set()
+        # Ubicación -> rowid de lo indexado en esta ejecución, para reubicarlo dentro del ZIP
+        self._locations = {}
+        self.count = 0
+
+    def submit(self, file_data, filename, location, relpath=None, msg_id=None, sender=None,
+               msg_date=None, subject=None, digest=None):
+        document = self._document(file_data, filename, location, relpath, msg_id, sender, msg_date, subject, digest)
+        if document and not self._queue_text(document, file_data):
+            self._insert_many([(document, '')])
+
+    def submit_many(self, entries):
+        """Indexa varios archivos ya escritos (entradas de AttachmentStore); los que no llevan texto, en una transacción"""
+        plain = []
+        for entry in entries:
+            document = self._document(entry['data'], entry['filename'], entry['location'], entry['relpath'],
+                                      entry['msg_id'], entry['sender'], entry['msg_date'], entry['subject'],
+                                      entry['sha256'])
+            if document and not self._queue_text(document, entry['data']):
+                plain.append((document, ''))
+        if plain:
+            self._insert_many(plain)
+
+    def _document(self, file_data, filename, location, relpath, msg_id, sender, msg_date, subject, digest):
+        """Fila del documento, o None si su contenido ya está indexado"""
+        digest = digest or hashlib.sha256(file_data).hexdigest()
+        with self._lock:
+            if digest in self._known:
+                return None
+            self._known.add(digest)
+        return {
+            'nombre': filename,
+            'asunto': subject or '',
+            'ubicacion': location,
+            'ruta': relpath or filename,
+            'id_mensaje': msg_id,
+            'remitente': sender,
+            'fecha_mensaje': msg_date.isoformat(timespec='seconds') if msg_date else None,
+            'sha256': digest,
+        }
+
+    def _queue_text(self, document, file_data):
+        """Manda a extraer el texto de un PDF/Excel; False si el archivo no tiene texto que extraer"""
+        if not document['nombre'].lower().endswith(('.pdf',) + EXCEL_EXTENSIONS):
+            return False
+        # El texto de PDF/Excel se extrae en otro proceso para no frenar la descarga
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots.acquire()
+        future = self._pool.submit(extract_text, file_data, document['nombre'])
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(lambda f: self._finish(f, document))
+        return True
+
+    def _finish(self, future, document):
+        try:
+            try:
+                text = future.result()
+            except Exception as e:
+                logging.warning(f"No se pudo extraer el texto de {document['nombre']}: {e}")
+                text = ''
+            self._insert_many([(document, text)])
+        except Exception as e:
+            logging.error(f"Error al indexar {document['nombre']}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(future)
+            self._slots.release()
+
+    def _insert_many(self, documents):
+        """Inserta [(documento, texto)] en una sola transacción"""
+        with self._lock, self._conn:
+            for document, text in documents:
+                cursor = self._conn.execute(
+                    "INSERT INTO documentos (nombre, asunto, contenido, ubicacion, ruta, id_mensaje, "
+                    "remitente, fecha_mensaje, sha256) VALUES (:nombre, :asunto, :contenido, :ubicacion, "
+                    ":ruta, :id_mensaje, :remitente, :fecha_mensaje, :sha256)",
+                    dict(document, contenido=text)
+                )
+                self._locations[document['ubicacion']] = cursor.lastrowid
+                self.count += 1
+
+    def wait(self):
+        """Espera a que se indexen los documentos pendientes"""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass  # Ya registrado en _finish
+
+    def relocate(self, zip_paths, base_dir=DOWNLOAD_DIR):
+        """Cambia la ubicación de lo indexado en DOWNLOAD_DIR a su entrada dentro del ZIP"""
+        self.wait()
+        with self._lock, self._conn:
+            for old_location, new_location in zip_relocations(zip_paths, base_dir):
+                rowid = self._locations.pop(old_location, None)
+                if rowid is not None:
+                    self._conn.execute(
+                        "UPDATE documentos SET ubicacion = ? WHERE rowid = ?", (new_location, rowid)
+                    )
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        with self._lock:
+            return search_documents(self._conn, text, limit)
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+        if self.count:
+            logging.info(f"Índice de búsqueda: {self.count} documentos nuevos -> {self.path}")
+
+def search_documents(conn, text, limit=SEARCH_LIMIT):
+    """Documentos que contienen todos los términos, ordenados por relevancia"""
+    query = fts_query(text)
+    if not query:
+        return []
+    return conn.execute(
+        "SELECT ubicacion, nombre, asunto, fecha_mensaje, "
+        "snippet(documentos, 2, '[', ']', '...', 10) "
+        "FROM documentos WHERE documentos MATCH ? ORDER BY rank LIMIT ?",
+        (query, limit)
+    ).fetchall()
+
+def zip_relocations(zip_paths, base_dir=DOWNLOAD_DIR):
+    """Pares (ruta en base_dir, zip!entrada) de los archivos empaquetados en los ZIP"""
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path) as zf:
+            for name in zf.namelist():
+                yield os.path.join(base_dir, *name.split('/')), f"{zip_path}!{name}"
+
+class IdentifierIndex:
+    """Tabla indexada de NIT de prestador y número de factura tomados de los nombres de archivo"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS facturas (
+            id INTEGER PRIMARY KEY,
+            nit TEXT NOT NULL,
+            factura TEXT NOT NULL,
+            tipo TEXT,
+            nombre_original TEXT NOT NULL,
+            ubicacion TEXT NOT NULL,
+            id_mensaje TEXT,
+            fecha_mensaje TEXT,
+            sha256 TEXT NOT NULL,
+            UNIQUE (nit, factura, sha256)
+        );
+        CREATE INDEX IF NOT EXISTS facturas_factura ON facturas (factura);
+    """
+
+    def __init__(self, path=STATE_DB):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        # Ubicación -> id de lo registrado en esta ejecución, para reubicarlo dentro del ZIP
+        self._locations = {}
+        self.count = 0
+
+    def add_many(self, entries):
+        """Registra varios archivos ya escritos (entradas de AttachmentStore) en una sola transacción"""
+        rows = []
+        for entry in entries:
+            ids = parse_filename_identifiers(entry['filename'])
+            if ids:
+                rows.append((entry, ids))
+        if not rows:
+            return
+        with self._lock, self._conn:
+            for entry, ids in rows:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO facturas (nit, factura, tipo, nombre_original, ubicacion, "
+                    "id_mensaje, fecha_mensaje, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (ids['nit'], ids['factura'], ids['tipo'], entry['filename'], entry['location'], entry['msg_id'],
+                     entry['msg_date'].isoformat(timespec='seconds') if entry['msg_date'] else None,
+                     entry['sha256'])
+                )
+                if cursor.rowcount:
+                    self._locations[entry['location']] = cursor.lastrowid
+                    self.count += 1
+
+    def relocate(self, zip_paths, base_dir=DOWNLOAD_DIR):
+        """Cambia la ubicación de lo registrado en DOWNLOAD_DIR a su entrada dentro del ZIP"""
+        with self._lock, self._conn:
+            for old_location, new_location in zip_relocations(zip_paths, base_dir):
+                row_id = self._locations.pop(old_location, None)
+                if row_id is not None:
+                    self._conn.execute("UPDATE facturas SET ubicacion = ? WHERE id = ?", (new_location, row_id))
+
+    def lookup(self, value):
+        """Archivos cuyo NIT o número de factura es exactamente `value` (búsqueda por índice)"""
+        value = value.strip().upper()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT nit, factura, tipo, nombre_original, ubicacion, fecha_mensaje FROM facturas "
+                "WHERE nit = ? UNION SELECT nit, factura, tipo, nombre_original, ubicacion, fecha_mensaje "
+                "FROM facturas WHERE factura = ? ORDER BY nit, factura, fecha_mensaje",
+                (value, value)
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        if self.count:
+            logging.info(f"Identificados {self.count} archivos por prestador y factura")
+
+def run_lookup(value):
+    """Imprime los archivos de un prestador (NIT) o de una factura"""
+    identifiers = IdentifierIndex()
+    try:
+        start = time.perf_counter()
+        rows = identifiers.lookup(value)
+        elapsed = (time.perf_counter() - start) * 1000
+        for nit, factura, tipo, name, location, msg_date in rows:
+            print(f"{nit} | {factura} | {tipo or '-'} | {msg_date or '-'}\n    {location}")
+        print(f"{len(rows)} resultados en {elapsed:.1f} ms")
+    finally:
+        identifiers.close()
+
+def index_archive(zip_path, index):
+    """Agrega al índice un ZIP ya creado, con la procedencia de su manifiesto si lo trae"""
+    zip_path = os.path.abspath(zip_path)
+    with zipfile.ZipFile(zip_path) as zf:
+        names = zf.namelist()
+        manifests = [name for name in names if MANIFEST_ENTRY_PATTERN.match(name)]
+        provenance = {}
+        for manifest_name in manifests:
+            if not manifest_name.endswith('.csv'):
+                continue
+            with zf.open(manifest_name) as f:
+                for row in csv.DictReader(io.TextIOWrapper(f, encoding='utf-8')):
+                    provenance[row['ruta_archivo']] = row
+        for name in names:
+            if name.endswith('/') or name in manifests:
+                continue
+            row = provenance.get(name, {})
+            msg_date = datetime.fromisoformat(row['fecha_mensaje']) if row.get('fecha_mensaje') else None
+            index.submit(zf.read(name), row.get('nombre_original') or os.path.basename(name),
+                         f"{zip_path}!{name}", name, row.get('id_mensaje'), row.get('remitente'), msg_date)
+    logging.info(f"Indexado {zip_path}: {len(names)} entradas")
+
+def run_search(text, path=SEARCH_DB):
+    """Imprime los archivos que coinciden con la búsqueda"""
+    if not os.path.exists(path):
+        print(f"No existe el índice {path}: ejecuta una descarga con --indexar o usa --indexar-zip")
+        return
+    # Solo lectura: sin esquema, sin cargar las sumas conocidas y sin bloquear a una descarga en curso
+    conn = sqlite3.connect(f"{Path(os.path.abspath(path)).as_uri()}?mode=ro", uri=True)
+    try:
+        start = time.perf_counter()
+        results = search_documents(conn, text)
+        elapsed = (time.perf_counter() - start) * 1000
+        for location, name, subject, msg_date, snippet in results:
+            print(f"{location}\n    {name} | {subject or '-'} | {msg_date or '-'}")
+            if snippet:
+                print(f"    {snippet}")
+        print(f"{len(results)} resultados en {elapsed:.1f} ms")
+    finally:
+        conn.close()
+
+# ============================
+# MODO VIGILANCIA
+# ============================
+class PushListener:
+    """Receptor local de notificaciones estilo Pub/Sub push: cada POST despierta al vigilante"""
+    def __init__(self, port, wake):
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                listener.notify(body)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(f"Notificación push: {format % args}")
+
+        self.wake = wake
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name='glosas-push', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"Escuchando notificaciones push en http://127.0.0.1:{self.server.server_port}/")
+        return self
+
+    def notify(self, body):
+        # Formato de Pub/Sub: {"message": {"data": base64({"emailAddress", "historyId"})}}
+        try:
+            data = json.loads(body)['message']['data']
+            payload = json.loads(base64.b64decode(data))
+            logging.info(f"Notificación push recibida (historyId {payload.get('historyId')})")
+        except (ValueError, KeyError, TypeError):
+            logging.info("Notificación push recibida")
+        self.wake.set()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def list_history(gmail, start_history_id):
+    """IDs de mensajes agregados desde start_history_id y el historyId más reciente"""
+    msg_ids = []
+    page_token = None
+    while True:
+        with STAGES.stage('api.history'):
+            response = gmail.users().history().list(
+                userId='me', startHistoryId=start_history_id,
+                historyTypes=['messageAdded'], pageToken=page_token
+            ).execute()
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg_ids.append(added['message']['id'])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return msg_ids, response['historyId']
+
+def fetch_sender(gmail, msg_id):
+    """Solo la cabecera From del mensaje (format=metadata), para filtrar antes de pedirlo completo"""
+    with STAGES.stage('api.get'):
+        return gmail.users().messages().get(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=['From']
+        ).execute()
+
+def watch_poll(gmail, remitente, keyword, state, cache, store, since=None):
+    """Un ciclo del vigilante: revisa el historial y descarga lo nuevo del remitente.
+
+    Sin cursor guardado solo se fija el punto de partida, o se recupera desde `since` ('AAAA/MM/DD');
+    si el cursor caducó, la búsqueda se limita a los días desde que se guardó.
+    """
+    downloaded_files = []
+    history_id = state.get_history_id()
+    catch_up_from = since
+    expired = False
+
+    if history_id is not None:
+        try:
+            msg_ids, latest = list_history(gmail, history_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # El historial de Gmail caduca (~1 semana): ponerse al día desde la fecha del cursor,
+            # con un día de margen porque 'after:' de Gmail compara fechas, no horas
+            updated = state.get_history_updated()
+            if updated is not None:
+                catch_up_from = (datetime.fromtimestamp(updated) - timedelta(days=1)).strftime("%Y/%m/%d")
+            logging.warning(f"El historyId guardado caducó, se revisará el buzón desde {catch_up_from or 'el inicio'}")
+            history_id = None
+            expired = True
+
+    if history_id is None:
+        # Fijar el cursor antes de buscar para no perder lo que llegue mientras tanto
+        # (lo repetido se descarta por los IDs procesados)
+        with STAGES.stage('api.list'):
+            latest = gmail.users().getProfile(userId='me').execute()['historyId']
+        if catch_up_from or expired:
+            query = build_query(remitente)
+            if catch_up_from:
+                query += f" after:{catch_up_from}"
+            downloaded_files, total_messages = process_messages_serial(
+                gmail, query, keyword, state, cache=cache, store=store
+            )
+        else:
+            logging.info("Primer ciclo de vigilancia: se descargará lo que llegue desde ahora "
+                         "(use --desde para recuperar correos anteriores)")
+        return finish_watch_poll(state, store, latest, downloaded_files)
+
+    for msg_id in dict.fromkeys(msg_ids):
+        if msg_id in state:
+            continue
+        try:
+            msg_data = cache.get(msg_id) if cache else None
+            # El historial trae todo el buzón: filtrar por remitente como hace la búsqueda,
+            # con solo la cabecera From para no descargar mensajes ajenos completos
+            headers = msg_data or fetch_sender(gmail, msg_id)
+            if remitente.lower() not in (get_header(headers, 'From') or '').lower():
+                continue
+            msg_data = msg_data or download_message(gmail, msg_id, cache)
+        except HttpError as e:
+            if e.resp.status == 404:
+                continue  # Borrado antes de revisarlo
+            raise
+        process_message(gmail, msg_id, keyword, state, cache, store, downloaded_files, msg_data=msg_data)
+
+    return finish_watch_poll(state, store, latest, downloaded_files)
+
+def finish_watch_poll(state, store, latest, downloaded_files):
+    """Cierra el ciclo: guarda los IDs y avanza el cursor solo si todos los archivos se escribieron"""
+    if store.flush():
+        # Sin avanzar el cursor, el próximo ciclo vuelve a ver los mensajes cuyos archivos fallaron
+        logging.warning("Hubo archivos sin escribir: el cursor del historial no avanza en este ciclo")
+        state.save(store.flush)
+    else:
+        state.set_history_id(latest, store.flush)
+    return [path for path in downloaded_files if path not in store.failed_locations]
+
+def watch_emails(remitente, keyword, destination=None, s3_endpoint=None,
+                 interval=WATCH_INTERVAL, listen_port=None, max_cycles=None, extract_excel=None,
+                 search_index=None, layout='fecha', fsync=True, since=None):
+    """Modo vigilancia: revisa el buzón cada `interval` segundos (o al recibir un push) y descarga lo nuevo"""
+    destination = destination or os.path.join(desktop_dir(), f"{keyword}_descargas")
+    credentials = CredentialManager(get_credentials()).start()
+    state = ProcessedState(keyword)
+    cache = MetadataCache()
+    sink = open_sink(destination, s3_endpoint)
+    recover_partial_outputs()
+    extractor = ExcelExtractor(extract_excel) if extract_excel else None
+    index = SearchIndex(search_index) if search_index else None
+    identifiers = IdentifierIndex()
+    # El planificador se conserva entre ciclos: cada carpeta se consulta una sola vez
+    planner = PathPlanner(sink, layout)
+    writer = WriteBehind(sink, fsync) if sink.write_behind else None
+    gmail, http = build_gmail_service(credentials, pool_size=4)
+    wake = threading.Event()
+    listener = PushListener(listen_port, wake).start() if listen_port is not None else None
+    logging.info(f"Vigilando correos de {remitente} con '{keyword}' cada {interval} s -> {sink.describe()}")
+
+    cycles = 0
+    try:
+        while max_cycles is None or cycles < max_cycles:
+            cycles += 1
+            manifest = RunManifest(tempfile.mkdtemp(prefix='glosas_manifiesto_'))
+            store = AttachmentStore(planner, manifest, extractor, index, identifiers, writer)
+            try:
+                downloaded_files = watch_poll(gmail, remitente, keyword, state, cache, store, since)
+                manifest.close()
+                if downloaded_files:
+                    upload_run_manifest(manifest, sink)
+                    logging.info(f"Vigilancia: {len(downloaded_files)} archivos nuevos")
+            except Exception as e:
+                # Un fallo puntual (red, cuota) no detiene la vigilancia: se reintenta en el próximo ciclo
+                logging.error(f"Error en el ciclo de vigilancia: {e}")
+                logging.debug(traceback.format_exc())
+                # Los mensajes ya revisados se guardan, salvo los que tienen archivos sin escribir
+                state.save(store.flush)
+            finally:
+                manifest.close()
+                shutil.rmtree(manifest.directory, ignore_errors=True)
+
+            if max_cycles is None or cycles < max_cycles:
+                wake.wait(interval)
+                wake.clear()
+    except KeyboardInterrupt:
+        logging.info("Vigilancia detenida por el usuario")
+    finally:
+        if listener:
+            listener.stop()
+        if writer:
+            writer.close()
+        http.close()
+        credentials.stop()
+        if extractor:
+            extractor.close()
+        if index:
+            index.close()
+        identifiers.close()
+        cache.close()
+        state.close()
+
+# ============================
+# TRANSPORTE HTTP
+# ============================
+class ConnectionStats:
+    """Contadores de conexiones HTTP abiertas frente a reutilizadas (keep-alive)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.opened = 0
+            self.reused = 0
+            self.api_calls = {}
+
+    def add(self, opened=0, reused=0):
+        with self._lock:
+            self.opened += opened
+            self.reused += reused
+
+    def add_call(self, kind):
+        """Cuenta una llamada a la API de Gmail por tipo (messages.get, attachments.get...)"""
+        with self._lock:
+            self.api_calls[kind] = self.api_calls.get(kind, 0) + 1
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.api_calls.values())
+
+    def summary(self):
+        total = self.opened + self.reused
+        ratio = (self.reused / total * 100) if total else 0.0
+        calls = ", ".join(f"{kind}={count}" for kind, count in sorted(self.api_calls.items()))
+        return (f"Conexiones HTTP: {self.opened} abiertas, {self.reused} reutilizadas ({ratio:.1f}% reutilización); "
+                f"llamadas a la API: {self.total_calls()} ({calls or '-'})")
+
+
+CONNECTION_STATS = ConnectionStats()
+
+def api_call_kind(uri):
+    """Tipo de llamada a partir de la URL de la API (users/me/messages/{id} -> messages.get)"""
+    path = urllib.parse.urlsplit(uri).path.split('/users/me/', 1)[-1]
+    segments = path.strip('/').split('/')
+    resource = segments[0]
+    if resource == 'messages' and 'attachments' in segments:
+        return 'attachments.get'
+    if resource in ('messages', 'threads'):
+        return f"{resource}.list" if len(segments) == 1 else f"{resource}.get"
+    if resource == 'history':
+        return 'history.list'
+    return resource
+
+
+class PooledHttp:
+    """Transporte compatible con httplib2 para googleapiclient sobre una sesión requests con pool"""
+    def __init__(self, credentials, pool_size=DEFAULT_CONCURRENCY):
+        self.credentials = credentials
+        self.session = requests.Session()
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=0
+        )
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._counted = {}
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        """Misma firma y retorno (respuesta, contenido) que httplib2.Http.request"""
+        headers = dict(headers or {})
+        kind = api_call_kind(uri)
+        for attempt in range(2):
+            CONNECTION_STATS.add_call(kind)
+            token = self.credentials.token()
+            headers['Authorization'] = f"Bearer {token}"
+            resp = self.session.request(
+                method, uri,
+                data=body,
+                headers=headers,
+                timeout=HTTP_TIMEOUT,
+                allow_redirects=redirections > 0
+            )
+            if resp.status_code != 401 or attempt:
+                break
+            self.credentials.refresh(token)
+        info = dict(resp.headers)
+        info['status'] = str(resp.status_code)
+        return httplib2.Response(info), resp.content
+
+    def collect_stats(self):
+        """Pasa a CONNECTION_STATS lo que urllib3 contó desde la última vez"""
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened, requests_made = self._counted.get(key, (0, 0))
+            new_opened = pool.num_connections - opened
+            new_requests = pool.num_requests - requests_made
+            CONNECTION_STATS.add(opened=new_opened, reused=max(0, new_requests - new_opened))
+            self._counted[key] = (pool.num_connections, pool.num_requests)
+
+    def close(self):
+        self.collect_stats()
+        self.session.close()
+
+
+def build_gmail_service(credentials, pool_size=DEFAULT_CONCURRENCY):
+    """Servicio de Gmail que comparte un único pool de conexiones entre list, get y adjuntos"""
+    http = PooledHttp(credentials, pool_size)
+    return build('gmail', 'v1', http=http), http
+
+
+# ============================
+# CUOTA DE LA API
+# ============================
+class QuotaScheduler:
+    """Cubeta de fichas sobre las unidades de cuota de Gmail, compartida por todo el proceso"""
+    def __init__(self, units_per_sec=GMAIL_QUOTA_UNITS_PER_SEC, burst=None):
+        self.rate = units_per_sec
+        self.capacity = burst or units_per_sec
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, units):
+        """Reserva las unidades y devuelve cuántos segundos hay que esperar para usarlas"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, units):
+        wait = self._reserve(units)
+        if wait:
+            with STAGES.stage('cuota'):
+                time.sleep(wait)
+
+    async def acquire_async(self, units):
+        wait = self._reserve(units)
+        if wait:
+            STAGES.record('cuota', wait)
+            await asyncio.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Ventana de solicitudes en curso con aumento aditivo y reducción multiplicativa (AIMD)"""
+    def __init__(self, max_window, initial=AIMD_INITIAL_WINDOW, min_window=AIMD_MIN_WINDOW, adaptive=True):
+        self.max_window = max_window
+        self.min_window = min(min_window, max_window)
+        self.adaptive = adaptive
+        self.window = float(min(max(initial, self.min_window), max_window) if adaptive else max_window)
+        self.inflight = 0
+        self.peak = self.window
+        self.decreases = {'cuota': 0, 'latencia': 0}
+        self._window_sum = 0.0
+        self._samples = 0
+        self._latency = {}  # (tipo de llamada, clase de tamaño) -> latencia habitual (media móvil)
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    @staticmethod
+    def size_class(size):
+        """Clase de tamaño de una respuesta: dentro de una clase los tamaños difieren menos del doble"""
+        size_class = 0
+        while size >= AIMD_SIZE_CLASS_BYTES << size_class:
+            size_class += 1
+        return size_class
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+
+    async def release(self, kind=None, latency=None, throttled=False):
+        """Libera el lugar y ajusta la ventana; la latencia se compara solo dentro del mismo tipo y tamaño"""
+        async with self._cond:
+            self.inflight -= 1
+            if self.adaptive and (latency is not None or throttled):
+                self._adjust(kind, latency, throttled)
+            self._cond.notify(max(0, self.limit - self.inflight))
+
+    def _adjust(self, kind, latency, throttled):
+        typical = self._latency.get(kind)
+        spike = latency is not None and typical is not None and latency > typical * AIMD_LATENCY_SPIKE
+        if latency is not None and not spike:
+            self._latency[kind] = latency if typical is None else 0.9 * typical + 0.1 * latency
+        if throttled or spike:
+            # Las respuestas de un mismo episodio llegan juntas: una sola reducción por latencia habitual
+            now = time.monotonic()
+            if now - self._last_decrease >= (typical or 1.0):
+                self.window = max(self.min_window, self.window * AIMD_DECREASE_FACTOR)
+                self._last_decrease = now
+                self.decreases['cuota' if throttled else 'latencia'] += 1
+        else:
+            # +1 por cada ventana completa de respuestas sanas
+            self.window = min(self.max_window, self.window + 1 / self.window)
+        self.peak = max(self.peak, self.window)
+        self._window_sum += self.window
+        self._samples += 1
+
+    def summary(self):
+        if not self.adaptive:
+            return f"Concurrencia fija: {self.max_window} solicitudes simultáneas"
+        average = self._window_sum / self._samples if self._samples else self.window
+        return (f"Concurrencia adaptativa: ventana final {self.limit} (máxima {int(self.peak)}, "
+                f"media {average:.1f}, límite {self.max_window}); reducciones: "
+                f"{self.decreases['cuota']} por 429/503, {self.decreases['latencia']} por latencia")
+
+
+# ============================
+# MOTOR ASÍNCRONO
+# ============================
+class AsyncGmailClient:
+    """Cliente HTTP asíncrono para la API de Gmail con pool de conexiones y token OAuth"""
+    def __init__(self, credentials, concurrency=DEFAULT_CONCURRENCY, quota=None, adaptive=True):
+        self.credentials = credentials
+        self.concurrency = concurrency
+        self.quota = quota or QuotaScheduler()
+        self.session = None
+        # La ventana se mueve entre AIMD_MIN_WINDOW y concurrency según latencia y 429/503
+        self.limiter = AdaptiveLimiter(concurrency, adaptive=adaptive)
+        # Los adjuntos grandes tienen su propia ventana: dos descargas de 20 MB no frenan a los pequeños
+        self.large_limiter = AdaptiveLimiter(LARGE_LANE_WORKERS, adaptive=adaptive)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency + LARGE_LANE_WORKERS, ttl_dns_cache=300,
+                                         keepalive_timeout=60)
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            raise_for_status=False,
+            trace_configs=[trace]
+        )
+        return self
+
+    @staticmethod
+    async def _on_connection_created(session, context, params):
+        CONNECTION_STATS.add(opened=1)
+
+    @staticmethod
+    async def _on_connection_reused(session, context, params):
+        CONNECTION_STATS.add(reused=1)
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _auth_headers(self):
+        return {'Authorization': f"Bearer {await self.credentials.token_async()}"}
+
+    async def request(self, path, params=None, cost_key='messages.get', size_class=None, limiter=None):
+        """GET a la API con cuota, reintentos exponenciales en 429/5xx y refresco en 401"""
+        limiter = limiter or self.limiter
+        url = f"{GMAIL_API_URL}/{path}"
+        params = {k: str(v) for k, v in (params or {}).items() if v is not None}
+        for attempt in range(MAX_RETRIES + 1):
+            await self.quota.acquire_async(GMAIL_QUOTA_COST[cost_key])
+            CONNECTION_STATS.add_call(cost_key)
+            delay = None
+            # Latencia hasta los encabezados; Gmail arma el cuerpo antes, así que crece con el tamaño
+            latency = None
+            throttled = False
+            await limiter.acquire()
+            try:
+                headers = await self._auth_headers()
+                start = time.perf_counter()
+                try:
+                    async with self.session.get(url, params=params, headers=headers) as resp:
+                        throttled = resp.status in THROTTLE_STATUS
+                        if resp.status == 200:
+                            latency = time.perf_counter() - start
+                            data = await resp.json()
+                            STAGES.record(f"api.{cost_key.split('.')[0]}", time.perf_counter() - start)
+                            return data
+                        body = await resp.text()
+                        if resp.status == 401 and attempt == 0:
+                            await asyncio.get_running_loop().run_in_executor(
+                                None, self.credentials.refresh, headers['Authorization'][7:]
+                            )
+                            continue
+                        if resp.status not in RETRY_STATUS:
+                            raise Exception(f"Error HTTP {resp.status} en {path}: {body[:200]}")
+                        retry_after = resp.headers.get('Retry-After')
+                        if retry_after and retry_after.isdigit():
+                            delay = float(retry_after)
+                        logging.warning(f"HTTP {resp.status} en {path}, reintento {attempt + 1}/{MAX_RETRIES}")
+                except asyncio.TimeoutError as e:
+                    throttled = True
+                    logging.warning(f"Error de conexión en {path}: {e!r}, reintento {attempt + 1}/{MAX_RETRIES}")
+                except aiohttp.ClientError as e:
+                    logging.warning(f"Error de conexión en {path}: {e!r}, reintento {attempt + 1}/{MAX_RETRIES}")
+            finally:
+                # Un adjunto de varios MB no es un pico frente a la línea base de los pequeños
+                await limiter.release((cost_key, size_class), latency, throttled)
+            if delay is None:
+                delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+            await asyncio.sleep(delay)
+        raise Exception(f"Se agotaron los reintentos para {path}")
+
+    async def list_messages(self, query, page_token=None):
+        return await self.request('messages', {'q': query, 'maxResults': 500, 'pageToken': page_token,
+                                               'fields': 'messages/id,nextPageToken'},
+                                  'messages.list')
+
+    async def get_message(self, msg_id):
+        return await self.request(f"messages/{msg_id}", cost_key='messages.get')
+
+    async def get_thread(self, thread_id):
+        return await self.request(f"threads/{thread_id}", cost_key='threads.get')
+
+    async def get_attachment(self, msg_id, att_id, size=0):
+        limiter = self.large_limiter if size >= LARGE_ATTACHMENT_BYTES else self.limiter
+        return await self.request(f"messages/{msg_id}/attachments/{att_id}", cost_key='attachments.get',
+                                  size_class=AdaptiveLimiter.size_class(size), limiter=limiter)
+
+
+class AttachmentLane:
+    """Carril de adjuntos con cola, trabajadores y presupuesto de memoria propios"""
+    def __init__(self, name, workers, memory_bytes):
+        self.name = name
+        self.workers = workers
+        self.memory_bytes = memory_bytes
+        self.queue = asyncio.Queue(maxsize=workers * 2)
+        self.used = 0
+        self.count = 0
+        self.bytes = 0
+        self._cond = asyncio.Condition()
+
+    async def reserve(self, size):
+        """Espera a que el adjunto quepa en el presupuesto; uno mayor que todo pasa con el carril vacío"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self.used or self.used + size <= self.memory_bytes)
+            self.used += size
+
+    async def release(self, size):
+        async with self._cond:
+            self.used -= size
+            self.count += 1
+            self.bytes += size
+            self._cond.notify_all()
+
+
+class AsyncDownloadEngine:
+    """Pipeline asíncrono: listado → metadatos → adjuntos → escritura, unidos por colas acotadas"""
+    def __init__(self, client, query, keyword, state, progress_window=None, cache=None, store=None,
+                 message_ids=None, threads=None):
+        self.client = client
+        self.message_ids = message_ids
+        # {threadId: [IDs nuevos]}: modo por conversaciones con un threads.get por hilo
+        self.threads = threads
+        self.thread_stats = ThreadFetchStats()
+        self.store = store or AttachmentStore()
+        self.query = query
+        self.keyword = keyword
+        self.state = state
+        self.progress_window = progress_window
+        self.cache = cache
+        self.concurrency = client.concurrency
+
+        self.finished_count = 0
+        self.downloaded_files = []
+        self.total_messages = 0
+        self.processed_count = 0
+        self.current_file = None
+        self._pending = {}  # msg_id -> adjuntos que faltan por escribir
+        # Los adjuntos pequeños no esperan detrás de los grandes: cada carril tiene su cola
+        self.small_lane = AttachmentLane('pequeños', self.concurrency, SMALL_LANE_MEMORY_MB * 1024 * 1024)
+        self.large_lane = AttachmentLane('grandes', min(LARGE_LANE_WORKERS, self.concurrency),
+                                         LARGE_LANE_MEMORY_MB * 1024 * 1024)
+        self._started = None
+        self.first_result_after = None
+        self._saved_count = 0
+        # Guardados de estado en curso: con referencia hasta terminar y esperados antes de cerrar
+        self._saves = set()
+        self._listing_done = False
+        # Hilos de E/S: las escrituras no bloquean el bucle; en disco local basta uno,
+        # en destinos remotos se suben varios archivos a la vez
+        self._io = ThreadPoolExecutor(max_workers=self.store.parallelism, thread_name_prefix='glosas-io')
+
+    async def run(self):
+        self._started = time.perf_counter()
+        msg_queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        write_queue = asyncio.Queue(maxsize=self.concurrency)
+        lanes = (self.small_lane, self.large_lane)
+
+        metadata_workers = [asyncio.create_task(self._fetch_metadata(msg_queue))
+                            for _ in range(self.concurrency)]
+        attachment_workers = [asyncio.create_task(self._fetch_attachments(lane, write_queue))
+                              for lane in lanes for _ in range(lane.workers)]
+        writer = asyncio.create_task(self._write(write_queue))
+        producer = asyncio.create_task(self._produce(msg_queue))
+        ui = asyncio.create_task(self._refresh_ui()) if self.progress_window else None
+        tasks = [producer] + metadata_workers + attachment_workers + [writer]
+
+        try:
+            await self._gather([producer], tasks)
+            # Cerrar cada etapa en orden con centinelas
+            for _ in metadata_workers:
+                await msg_queue.put(None)
+            await self._gather(metadata_workers, tasks)
+            for lane in lanes:
+                for _ in range(lane.workers):
+                    await lane.queue.put(None)
+            await self._gather(attachment_workers, tasks)
+            await write_queue.put(None)
+            await self._gather([writer], tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if ui:
+                ui.cancel()
+            if self._saves:
+                await asyncio.gather(*self._saves, return_exceptions=True)
+            await self._save_state()
+            self._io.shutdown(wait=True)
+
+        if self.thread_stats.messages:
+            logging.info(self.thread_stats.summary())
+        logging.info(self._lanes_summary())
+        return self.downloaded_files, self.total_messages
+
+    def _lanes_summary(self):
+        lanes = ", ".join(f"{lane.name} {lane.count} ({lane.bytes / 1024 / 1024:.1f} MB)"
+                          for lane in (self.small_lane, self.large_lane))
+        first = (f"; primer archivo guardado a los {self.first_result_after:.2f} s"
+                 if self.first_result_after is not None else "")
+        return f"Adjuntos por carril: {lanes}{first}"
+
+    def _lane_for(self, part):
+        return self.large_lane if part['body'].get('size', 0) >= LARGE_ATTACHMENT_BYTES else self.small_lane
+
+    @staticmethod
+    async def _gather(stage_tasks, all_tasks):
+        """Espera una etapa; si cualquier tarea del pipeline falla, el error sube de inmediato"""
+        while not all(task.done() for task in stage_tasks):
+            await asyncio.wait([task for task in all_tasks if not task.done()],
+                               return_when=asyncio.FIRST_COMPLETED)
+            for task in all_tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception()
+
+    async def _produce(self, msg_queue):
+        """Etapa 1: recorre las páginas del listado (o los IDs del preconteo) y encola los no procesados"""
+        if self.threads is not None:
+            self.total_messages = len(self.message_ids)
+            self.processed_count = self.total_messages - sum(len(ids) for ids in self.threads.values())
+            self._listing_done = True
+            for thread_id, msg_ids in self.threads.items():
+                await msg_queue.put((thread_id, msg_ids))
+            return
+        if self.message_ids is not None:
+            self.total_messages = len(self.message_ids)
+            self._listing_done = True
+            for msg_id in self.message_ids:
+                if msg_id in self.state:
+                    self.processed_count += 1
+                    continue
+                await msg_queue.put(msg_id)
+            return
+        page_token = None
+        while True:
+            response = await self.client.list_messages(self.query, page_token)
+            messages = response.get('messages', [])
+            self.total_messages += len(messages)
+            logging.info(f"Listados {len(messages)} mensajes (total {self.total_messages})")
+            for msg in messages:
+                msg_id = msg['id']
+                if msg_id in self.state:
+                    self.processed_count += 1
+                    continue
+                await msg_queue.put(msg_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        self._listing_done = True
+
+    async def _fetch_metadata(self, msg_queue):
+        """Etapa 2: obtiene cada mensaje (o conversación) y encola sus adjuntos con la palabra clave"""
+        while True:
+            item = await msg_queue.get()
+            if item is None:
+                return
+            seen = None
+            try:
+                if isinstance(item, tuple):
+                    messages = await self._get_thread_messages(*item)
+                    seen = set()
+                else:
+                    messages = [await self._get_message(item)]
+            except Exception as e:
+                # Los mensajes no se marcan como procesados para reintentarlos en otra ejecución
+                msg_ids = item[1] if isinstance(item, tuple) else [item]
+                logging.error(f"Error al obtener {', '.join(msg_ids)}: {e}")
+                self.processed_count += len(msg_ids)
+                continue
+            for msg_data in messages:
+                await self._queue_parts(msg_data, seen)
+
+    async def _get_message(self, msg_id):
+        msg_data = self.cache.get(msg_id) if self.cache else None
+        if msg_data is None:
+            msg_data = await self.client.get_message(msg_id)
+            if self.cache:
+                self.cache.put(msg_data)
+        return msg_data
+
+    async def _get_thread_messages(self, thread_id, msg_ids):
+        """Los mensajes pedidos de una conversación con un solo threads.get (o desde la caché)"""
+        cached = {msg_id: self.cache.get(msg_id) for msg_id in msg_ids} if self.cache else {}
+        missing = [msg_id for msg_id in msg_ids if cached.get(msg_id) is None]
+        self.thread_stats.messages += len(msg_ids)
+        self.thread_stats.uncached += len(missing)
+        fetched = {}
+        if missing:
+            thread = await self.client.get_thread(thread_id)
+            self.thread_stats.threads += 1
+            fetched = {msg['id']: msg for msg in thread.get('messages', [])}
+        messages = []
+        for msg_id in msg_ids:
+            msg_data = cached.get(msg_id) or fetched.get(msg_id)
+            if msg_data is None:
+                self.processed_count += 1  # Borrado entre el listado y la descarga
+                continue
+            if self.cache and msg_id in missing:
+                self.cache.put(msg_data)
+            messages.append(msg_data)
+        return messages
+
+    async def _queue_parts(self, msg_data, seen=None):
+        msg_id = msg_data['id']
+        msg_date = get_message_date(msg_data)
+        sender = get_header(msg_data, 'From')
+        subject = get_header(msg_data, 'Subject')
+        parts = [part for part in find_matching_parts(msg_data, self.keyword)
+                 if seen is None or not self.thread_stats.is_duplicate(part, seen)]
+        if not parts:
+            self._finish_message(msg_id)
+            return
+        self._pending[msg_id] = len(parts)
+        for part in parts:
+            logging.info(f"Archivo encontrado: {part['filename']}")
+            await self._lane_for(part).queue.put((msg_id, part, msg_date, sender, subject))
+
+    async def _fetch_attachments(self, lane, write_queue):
+        """Etapa 3: descarga y decodifica el contenido de cada adjunto de su carril"""
+        while True:
+            item = await lane.queue.get()
+            if item is None:
+                return
+            msg_id, part, msg_date, sender, subject = item
+            filename = part['filename']
+            file_data = None
+            # La memoria se libera cuando el archivo ya está escrito
+            size = part['body'].get('size', 0)
+            await lane.reserve(size)
+            try:
+                att = await self.client.get_attachment(msg_id, part['body']['attachmentId'], size)
+                data = att.get('data')
+                if data:
+                    with STAGES.stage('base64'):
+                        file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
+                else:
+                    logging.warning(f"No hay datos en el adjunto {filename}")
+            except Exception as e:
+                logging.error(f"Error al descargar adjunto {filename}: {e}")
+            await write_queue.put((msg_id, part, msg_date, sender, subject, file_data))
+
+    async def _write(self, write_queue):
+        """Etapa 4: guarda los archivos en el destino desde los hilos de E/S"""
+        slots = asyncio.Semaphore(self.store.parallelism)
+        writes = set()
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(self._write_one(item, slots))
+            writes.add(task)
+            task.add_done_callback(writes.discard)
+        if writes:
+            await asyncio.gather(*writes)
+
+    async def _write_one(self, item, slots):
+        msg_id, part, msg_date, sender, subject, file_data = item
+        filename = part['filename']
+        try:
+            if file_data is not None:
+                self.current_file = filename
+                location = await asyncio.get_running_loop().run_in_executor(
+                    self._io, self.store.save, file_data, filename, msg_date,
+                    msg_id, part['body']['attachmentId'], sender, subject
+                )
+                self.downloaded_files.append(location)
+                if self.first_result_after is None:
+                    self.first_result_after = time.perf_counter() - self._started
+        except Exception as e:
+            logging.error(f"Error al guardar adjunto {filename}: {e}")
+        finally:
+            slots.release()
+            await self._lane_for(part).release(part['body'].get('size', 0))
+        self._pending[msg_id] -= 1
+        if not self._pending[msg_id]:
+            del self._pending[msg_id]
+            self._finish_message(msg_id)
+
+    def _finish_message(self, msg_id):
+        self.state.add(msg_id)
+        self.finished_count += 1
+        self.processed_count += 1
+        if self.finished_count - self._saved_count >= STATE_SAVE_EVERY:
+            task = asyncio.create_task(self._save_state())
+            self._saves.add(task)
+            task.add_done_callback(self._saves.discard)
+
+    async def _save_state(self):
+        """Guarda los IDs nuevos en el hilo de E/S sin detener el pipeline"""
+        self._saved_count = self.finished_count
+        start = time.perf_counter()
+        # Un mensaje solo queda procesado cuando sus archivos ya están en el destino
+        await asyncio.get_running_loop().run_in_executor(self._io, self.state.save, self.store.flush)
+        STAGES.record('estado', time.perf_counter() - start)
+
+    async def _refresh_ui(self):
+        """Refresca la ventana de progreso a intervalos fijos en lugar de por cada evento"""
+        while True:
+            total = self.total_messages
+            status = (f"Procesando mensajes ({self.processed_count}/{total})..."
+                      if self._listing_done else f"Listando mensajes ({total})...")
+            if self.client.limiter.adaptive:
+                status += f" · {self.client.limiter.limit} solicitudes en curso como máximo"
+            self.progress_window.update_status(status)
+            self.progress_window.update_progress(self.processed_count, total)
+            self.progress_window.update_files(len(self.downloaded_files))
+            if self.current_file:
+                self.progress_window.update_current_file(self.current_file)
+            await asyncio.sleep(0.2)
+
+
+async def run_async_engine(credentials, query, keyword, state, progress_window=None,
+                           concurrency=DEFAULT_CONCURRENCY, cache=None, store=None, message_ids=None,
+                           threads=None, adaptive=True):
+    """Ejecuta el motor asíncrono y devuelve (archivos descargados, mensajes revisados)"""
+    async with AsyncGmailClient(credentials, concurrency, adaptive=adaptive) as client:
+        engine = AsyncDownloadEngine(client, query, keyword, state, progress_window, cache, store,
+                                     message_ids, threads)
+        try:
+            return await engine.run()
+        finally:
+            logging.info(client.limiter.summary())
+            logging.info(f"Adjuntos grandes: {client.large_limiter.summary()}")
+
+# ============================
+# BENCHMARKS
+# ============================
+def _measure(construct):
+    """Construye la estructura midiendo tiempo y memoria asignada (tracemalloc)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = construct()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, memory
+
+def _lookups_per_sec(container, probes):
+    start = time.perf_counter()
+    for probe in probes:
+        probe in container
+    return len(probes) / (time.perf_counter() - start)
+
+def benchmark_id_index(count=1_000_000, probes=100_000):
+    """Compara set de str, set de int y CompactIdIndex con count IDs tipo Gmail"""
+    rnd = random.Random(42)
+    base = 0x18C0000000000000
+    values = sorted({base + rnd.getrandbits(44) for _ in range(count)})
+    hex_ids = [f"{value:016x}" for value in values]
+    hits = rnd.sample(values, probes)
+    misses = [base + rnd.getrandbits(44) | (1 << 45) for _ in range(probes)]
+
+    lines = [f"Índice de IDs procesados con {len(values):,} IDs",
+             f"{'Estructura':<26} {'Carga (s)':>10} {'Memoria (MB)':>13} {'Aciertos/s':>12} {'Fallos/s':>12}"]
+    # Cada estructura crea sus propios objetos para que la memoria medida sea la real
+    candidates = [
+        ('set de str (JSON antiguo)', lambda: set(json.loads(json.dumps(hex_ids))),
+         [f"{h:016x}" for h in hits], [f"{m:016x}" for m in misses]),
+        ('set de int', lambda: {int(h, 16) for h in hex_ids}, hits, misses),
+        ('CompactIdIndex', lambda: CompactIdIndex(array('Q', (int(h, 16) for h in hex_ids))), hits, misses),
+    ]
+    for name, build_fn, hit_probes, miss_probes in candidates:
+        container, elapsed, memory = _measure(build_fn)
+        lines.append(f"{name:<26} {elapsed:>10.2f} {memory / 1e6:>13.1f} "
+                     f"{_lookups_per_sec(container, hit_probes):>12,.0f} "
+                     f"{_lookups_per_sec(container, miss_probes):>12,.0f}")
+        del container
+
+    # Altas una a una (fusiones por lotes incluidas)
+    index = CompactIdIndex(array('Q', values))
+    extra = [base + (1 << 45) + i for i in range(probes)]
+    start = time.perf_counter()
+    for value in extra:
+        index.add(value)
+    lines.append(f"CompactIdIndex: {probes:,} altas en {time.perf_counter() - start:.2f} s")
+    del index
+
+    # Persistencia: volcado JSON completo (antes, en cada página) frente a SQLite incremental
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'processed_ids.json')
+        start = time.perf_counter()
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(hex_ids, f, indent=2)
+        lines.append(f"Guardado JSON completo: {time.perf_counter() - start:.2f} s "
+                     f"({os.path.getsize(json_path) / 1e6:.1f} MB)")
+
+        db_path = os.path.join(tmp, 'estado.db')
+        state = ProcessedState('BENCH', path=db_path)
+        start = time.perf_counter()
+        for msg_id in hex_ids:
+            state.add(msg_id)
+        state.save()
+        lines.append(f"Alta y guardado inicial en SQLite: {time.perf_counter() - start:.2f} s "
+                     f"({os.path.getsize(db_path) / 1e6:.1f} MB)")
+        page = [f"{base + (1 << 46) + i:016x}" for i in range(500)]
+        start = time.perf_counter()
+        for msg_id in page:
+            state.add(msg_id)
+        state.save()
+        lines.append(f"Guardado incremental de una página (500 IDs): {(time.perf_counter() - start) * 1000:.1f} ms")
+        state.close()
+
+        start = time.perf_counter()
+        state = ProcessedState('BENCH', path=db_path)
+        lines.append(f"Carga desde SQLite: {time.perf_counter() - start:.2f} s")
+        state.close()
+    return lines
+
+def _sample_payloads(count):
+    """Mensajes tipo glosa: cuerpo texto/HTML con imágenes en línea, adjuntos y reenvíos"""
+    def leaf(mime, filename='', attachment=True):
+        body = {'size': 1000}
+        if attachment:
+            body['attachmentId'] = 'ANGjdJ' + 'x' * 120
+        else:
+            body['data'] = 'aGVsbG8='
+        return {'partId': '', 'mimeType': mime, 'filename': filename, 'headers': [], 'body': body}
+
+    def message(i, forwarded=0):
+        body = {'mimeType': 'multipart/alternative', 'parts': [
+            leaf('text/plain', attachment=False),
+            {'mimeType': 'multipart/related', 'parts': [
+                leaf('text/html', attachment=False),
+                leaf('image/png', 'image001.png'),
+                leaf('image/jpeg', 'image002.jpg'),
+            ]},
+        ]}
+        parts = [body] + [
+            leaf('application/pdf', f"GLOSAS PRESTADOR 76001037990{j}_2005{i:05d}.pdf") for j in range(3)
+        ] + [leaf('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', f"detalle_{i}.xlsx")]
+        if forwarded:
+            parts.append({'mimeType': 'message/rfc822', 'filename': 'reenviado.eml',
+                          'body': {'attachmentId': 'ANGjdJfwd'}, 'parts': [message(i, forwarded - 1)]})
+        return {'mimeType': 'multipart/mixed', 'parts': parts}
+
+    # Uno de cada cuatro mensajes es una cadena de dos reenvíos
+    return [message(i, forwarded=2 if i % 4 == 0 else 0) for i in range(count)]
+
+def benchmark_mime_walker(count=20_000, rounds=5):
+    """Compara get_parts + filtro con iter_attachment_parts sobre mensajes realistas"""
+    payloads = _sample_payloads(count)
+    keyword = 'GLOSAS'
+
+    def old(payload):
+        return [part for part in get_parts(payload)
+                if part.get('filename') and keyword in part['filename'].upper()]
+
+    def new(payload):
+        return list(iter_attachment_parts(payload, keyword))
+
+    lines = [f"Recorrido MIME de {count:,} mensajes ({rounds} rondas, palabra clave '{keyword}')",
+             f"{'Recorrido':<26} {'Mensajes/s':>12} {'Memoria pico (KB)':>18} {'Adjuntos':>9}"]
+    for name, func in (('get_parts + filtro', old), ('iter_attachment_parts', new)):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            found = sum(len(func(payload)) for payload in payloads)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        for payload in payloads[:1000]:
+            func(payload)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        lines.append(f"{name:<26} {count / best:>12,.0f} {peak / 1024:>18.1f} {found:>9,}")
+
+    # Anidamiento extremo: el recorrido recursivo agota la pila de Python
+    deep = {'mimeType': 'application/pdf', 'filename': 'GLOSAS profundo.pdf', 'body': {'attachmentId': 'x'}}
+    for _ in range(5000):
+        deep = {'mimeType': 'multipart/mixed', 'parts': [deep]}
+    try:
+        old(deep)
+        lines.append("get_parts con 5000 niveles: correcto")
+    except RecursionError:
+        lines.append("get_parts con 5000 niveles: RecursionError")
+    lines.append(f"iter_attachment_parts con 5000 niveles: {len(new(deep))} adjunto(s)")
+    return lines
+
+def benchmark_zip_store(total_mb=ZIP_BENCHMARK_MB, file_mb=2):
+    """Empaqueta una carpeta de total_mb de PDF simulados: DEFLATE, STORED con zipfile y STORED sin copias"""
+    rnd = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        staging = os.path.join(tmp, 'descargas')
+        checksums = {}
+        written = 0
+        # Contenido aleatorio: tan poco comprimible como un PDF escaneado; el CRC se toma al "descargar"
+        while written < total_mb * 1024 * 1024:
+            size = rnd.randint(file_mb * 1024 * 1024 // 4, file_mb * 1024 * 1024 * 7 // 4)
+            data = os.urandom(size)
+            folder = os.path.join(staging, f"2025-{MONTH_NAMES[len(checksums) % 12 + 1]}")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"GLOSAS_{len(checksums):06d}.pdf")
+            with open(path, 'wb') as f:
+                f.write(data)
+            checksums[os.path.normpath(path)] = (zlib.crc32(data), size)
+            written += size
+        files = sorted(checksums)
+
+        def with_zipfile(compression):
+            def pack(base_path):
+                with zipfile.ZipFile(f"{base_path}.zip", 'w', compression, allowZip64=True) as zf:
+                    for path in files:
+                        zf.write(path, os.path.relpath(path, staging))
+            return pack
+
+        def zero_copy(base_path):
+            with ArchiveWriter(base_path, checksums=checksums) as writer:
+                for path in files:
+                    writer.add(path, os.path.relpath(path, staging))
+
+        lines = [f"Empaquetado de {len(files):,} archivos ({written / 1e9:.2f} GB)",
+                 f"{'Método':<30} {'Tiempo (s)':>11} {'CPU (s)':>9} {'MB/s':>9} {'ZIP (MB)':>10}"]
+        for name, pack in (('zipfile DEFLATE (antes)', with_zipfile(zipfile.ZIP_DEFLATED)),
+                            ('zipfile STORED', with_zipfile(zipfile.ZIP_STORED)),
+                            ('STORED sin copias (CRC previo)', zero_copy)):
+            base_path = os.path.join(tmp, 'prueba')
+            start, cpu_start = time.perf_counter(), time.process_time()
+            pack(base_path)
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            zip_size = os.path.getsize(f"{base_path}.zip")
+            lines.append(f"{name:<30} {elapsed:>11.2f} {cpu:>9.2f} {written / 1e6 / elapsed:>9.0f} "
+                         f"{zip_size / 1e6:>10.0f}")
+            os.remove(f"{base_path}.zip")
+    return lines
+
+BENCHMARKS = {
+    'ids': benchmark_id_index,
+    'mime': benchmark_mime_walker,
+    'zip': benchmark_zip_store,
+}
+
+def run_benchmark(name):
+    for line in BENCHMARKS[name]():
+        logging.info(line)
 
 # ============================
 # EJECUCIÓN
 # ============================
+def parse_args(argv=None):
+    """Opciones de línea de comandos (la interfaz gráfica sigue siendo el flujo principal)"""
+    parser = argparse.ArgumentParser(description="Descargador de adjuntos de Gmail - HUV")
+    parser.add_argument(
+        '--profile', nargs='?', const='auto', choices=['auto', 'cprofile', 'muestreo'],
+        help="Perfila la ejecución y guarda el resultado junto al log "
+             "(muestreo con pyinstrument si está disponible, si no cProfile)"
+    )
+    parser.add_argument(
+        '--profile-top', type=int, default=PROFILE_TOP_N,
+        help="Número de funciones a incluir en el resumen del perfilado"
+    )
+    parser.add_argument(
+        '--benchmark', choices=sorted(BENCHMARKS),
+        help="Ejecuta un micro-benchmark sin interfaz gráfica y termina"
+    )
+    parser.add_argument(
+        '--motor', choices=['auto', 'async', 'sync'], default='auto',
+        help="Motor de descarga: asíncrono (requiere aiohttp) o secuencial"
+    )
+    parser.add_argument(
+        '--concurrencia', type=int, default=DEFAULT_CONCURRENCY,
+        help="Máximo de solicitudes simultáneas del motor asíncrono (la ventana se ajusta sola hasta este valor)"
+    )
+    parser.add_argument(
+        '--concurrencia-fija', action='store_true',
+        help="Desactiva el ajuste automático y usa siempre --concurrencia solicitudes simultáneas"
+    )
+    parser.add_argument(
+        '--sin-fsync', action='store_true',
+        help="No sincroniza cada archivo con el disco al escribirlo (más rápido, menos seguro ante cortes)"
+    )
+    parser.add_argument(
+        '--volumen-mb', type=int,
+        help="Divide el ZIP en volúmenes de como máximo este tamaño"
+    )
+    parser.add_argument(
+        '--volumen-archivos', type=int,
+        help="Divide el ZIP en volúmenes de como máximo este número de archivos"
+    )
+    parser.add_argument(
+        '--volumen-por-mes', action='store_true',
+        help="Un volumen por carpeta de mes (Año-Mes)"
+    )
+    parser.add_argument(
+        '--zip-mensual', action='store_true',
+        help="Anexa lo nuevo al ZIP del mes en el escritorio ({PALABRA}_{Año-Mes}.zip) en lugar de crear uno por ejecución"
+    )
+    parser.add_argument(
+        '--zip-paralelo', action='store_true',
+        help="Un ZIP por carpeta Año-Mes, construidos en paralelo, con un índice .indice.json de todos"
+    )
+    parser.add_argument(
+        '--destino',
+        help="Guarda los archivos directamente en una carpeta (local o sincronizada con Drive) "
+             "o en s3://bucket/prefijo en lugar de crear el ZIP"
+    )
+    parser.add_argument(
+        '--s3-endpoint',
+        help="URL de un servicio compatible con S3 (MinIO, Ceph...) para --destino s3://"
+    )
+    parser.add_argument(
+        '--vigilar', action='store_true',
+        help="Modo vigilancia sin interfaz: descarga continuamente los correos nuevos "
+             "(requiere --remitente y --palabra-clave)"
+    )
+    parser.add_argument('--remitente', help="Correo del remitente para --vigilar")
+    parser.add_argument('--palabra-clave', help="Palabra clave de los adjuntos para --vigilar")
+    parser.add_argument(
+        '--desde', metavar='DD/MM/AAAA',
+        help="En modo vigilancia, descarga también los correos desde esta fecha la primera vez "
+             "(por defecto solo lo que llegue desde ahora)"
+    )
+    parser.add_argument(
+        '--intervalo', type=int, default=WATCH_INTERVAL,
+        help="Segundos entre revisiones del buzón en modo vigilancia"
+    )
+    parser.add_argument(
+        '--escuchar', type=int, metavar='PUERTO',
+        help="Recibe notificaciones push (formato Pub/Sub) en 127.0.0.1:PUERTO para revisar al instante"
+    )
+    parser.add_argument(
+        '--extraer-excel', nargs='?', const=EXCEL_DB, metavar='RUTA_DB',
+        help="Extrae las filas de los .xlsx/.xls descargados a una base SQLite "
+             f"(por defecto {os.path.basename(EXCEL_DB)} junto al log)"
+    )
+    parser.add_argument(
+        '--indexar', nargs='?', const=SEARCH_DB, metavar='RUTA_DB',
+        help="Agrega los archivos descargados (nombre, asunto y texto de PDF/Excel) al índice de búsqueda"
+    )
+    parser.add_argument(
+        '--indexar-zip', nargs='+', metavar='ZIP',
+        help="Agrega al índice de búsqueda ZIP ya creados y termina"
+    )
+    parser.add_argument(
+        '--buscar', metavar='TEXTO',
+        help="Busca en el índice (p. ej. un número de factura o NIT) y termina"
+    )
+    parser.add_argument(
+        '--organizar', choices=['fecha', 'prestador', 'factura'], default='fecha',
+        help="Carpetas por fecha (Año-Mes/Semana_N), por prestador (Prestador_NIT) "
+             "o por factura (Prestador_NIT/Factura_N), según el nombre del archivo"
+    )
+    parser.add_argument(
+        '--consultar', metavar='NIT_O_FACTURA',
+        help="Lista los archivos descargados de un prestador o de una factura y termina"
+    )
+    parser.add_argument(
+        '--por-conversacion', action='store_true',
+        help="Obtiene cada conversación con un solo threads.get y omite adjuntos repetidos en el hilo"
+    )
+    args = parser.parse_args(argv)
+    if args.vigilar and not (args.remitente and args.palabra_clave):
+        parser.error("--vigilar requiere --remitente y --palabra-clave")
+    if args.desde:
+        try:
+            args.desde = datetime.strptime(args.desde, "%d/%m/%Y").strftime("%Y/%m/%d")
+        except ValueError:
+            parser.error("Formato de fecha inválido en --desde. Use DD/MM/AAAA")
+    return args
 
 
 if __name__ == "__main__":
+    # Necesario para el pool de procesos de la extracción de Excel en el .exe de PyInstaller
+    multiprocessing.freeze_support()
+    args = parse_args()
+    if args.benchmark:
+        run_benchmark(args.benchmark)
+        sys.exit(0)
+    if args.indexar_zip:
+        index = SearchIndex(args.indexar or SEARCH_DB)
+        try:
+            for zip_path in args.indexar_zip:
+                index_archive(zip_path, index)
+        finally:
+            index.close()
+        sys.exit(0)
+    if args.buscar:
+        run_search(args.buscar, args.indexar or SEARCH_DB)
+        sys.exit(0)
+    if args.consultar:
+        run_lookup(args.consultar)
+        sys.exit(0)
+    if args.vigilar:
+        watch_emails(args.remitente.strip(), args.palabra_clave.strip(), args.destino, args.s3_endpoint,
+                     args.intervalo, args.escuchar, extract_excel=args.extraer_excel,
+                     search_index=args.indexar, layout=args.organizar, fsync=not args.sin_fsync,
+                     since=args.desde)
+        sys.exit(0)
+
     # Crear una ventana raíz que permanezca durante toda la ejecución
     root = tk.Tk()
     root.title("Descargador de adjuntos - HUV")
@@ -844,7 +4670,30 @@ if __name__ == "__main__":
         )
 
         # Procesar emails
-        process_emails(remitente, keyword, fechas['desde'], fechas['hasta'], root)
+        run_options = {
+            'engine': args.motor,
+            'concurrency': args.concurrencia,
+            'archive_options': {
+                'volume_mb': args.volumen_mb,
+                'volume_files': args.volumen_archivos,
+                'volume_per_month': args.volumen_por_mes,
+                'append_monthly': args.zip_mensual,
+                'parallel_months': args.zip_paralelo,
+            },
+            'destination': args.destino,
+            's3_endpoint': args.s3_endpoint,
+            'extract_excel': args.extraer_excel,
+            'search_index': args.indexar,
+            'layout': args.organizar,
+            'by_thread': args.por_conversacion,
+            'adaptive_concurrency': not args.concurrencia_fija,
+            'fsync': not args.sin_fsync,
+        }
+        if args.profile:
+            run_profiled(process_emails, remitente, keyword, fechas['desde'], fechas['hasta'], root,
+                         mode=args.profile, top_n=args.profile_top, **run_options)
+        else:
+            process_emails(remitente, keyword, fechas['desde'], fechas['hasta'], root, **run_options)
 
     except Exception as e:
         error_details = traceback.format_exc()
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# file_downloader crea APPDATA_DIR y el log al importarse: se apuntan a una carpeta temporal
+_SESSION_DIR = tempfile.mkdtemp(prefix='glosas_pruebas_')
+os.environ['LOCALAPPDATA'] = _SESSION_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_downloader  # noqa: E402
+
+
+@pytest.fixture
+def fd(tmp_path, monkeypatch):
+    """file_downloader con APPDATA_DIR, estado y Escritorio propios de cada prueba"""
+    appdata = tmp_path / 'appdata'
+    home = tmp_path / 'home'
+    appdata.mkdir()
+    (home / 'Desktop').mkdir(parents=True)
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.setenv('USERPROFILE', str(home))
+    monkeypatch.setattr(file_downloader, 'APPDATA_DIR', str(appdata))
+    monkeypatch.setattr(file_downloader, 'PROCESSED_FILE', str(appdata / 'processed_ids.json'))
+    monkeypatch.setattr(file_downloader, 'DOWNLOAD_DIR', str(appdata / 'downloads'))
+    return file_downloader
@@ -0,0 +1,106 @@
+import os
+import zipfile
+import zlib
+
+import pytest
+
+
+def make_downloads(fd, names):
+    """Archivos en DOWNLOAD_DIR con su manifiesto, como los deja una descarga"""
+    paths = []
+    for name in names:
+        path = os.path.join(fd.DOWNLOAD_DIR, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(name.encode() * 50)
+        paths.append(path)
+    with open(os.path.join(fd.DOWNLOAD_DIR, fd.MANIFEST_CSV), 'w', encoding='utf-8') as f:
+        f.write('ruta_archivo\n' + '\n'.join(names) + '\n')
+    return paths
+
+
+def test_append_accumulates_entries_across_runs(fd, tmp_path):
+    source = tmp_path / 'a.pdf'
+    source.write_bytes(b'%PDF' * 500)
+    base_path = fd.archive_base_path('glosas')
+    for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+        with fd.ArchiveWriter(base_path, append=True) as writer:
+            writer.add(str(source), f"2025-Noviembre/Semana_47/{name}")
+
+    zip_path = writer.volumes[0][0]
+    assert os.path.basename(zip_path) == 'GLOSAS_2025-Noviembre.zip'
+    assert not os.path.exists(zip_path + fd.ARCHIVE_JOURNAL_SUFFIX)
+    with zipfile.ZipFile(zip_path) as zf:
+        assert [name.rsplit('/', 1)[1] for name in zf.namelist()] == ['a.pdf', 'b.pdf', 'c.pdf']
+        assert zf.testzip() is None
+
+
+def test_failed_verification_restores_from_journal(fd, tmp_path):
+    source = tmp_path / 'a.pdf'
+    source.write_bytes(b'%PDF' * 500)
+    base_path = fd.archive_base_path('glosas')
+    with fd.ArchiveWriter(base_path, append=True) as writer:
+        writer.add(str(source), '2025-Noviembre/Semana_47/a.pdf')
+    zip_path = writer.volumes[0][0]
+    with open(zip_path, 'rb') as f:
+        before = f.read()
+
+    with pytest.raises(Exception, match='no contiene todas las entradas'):
+        with fd.ArchiveWriter(base_path, append=True) as writer:
+            writer.add(str(source), '2025-Noviembre/Semana_47/b.pdf')
+            writer._current['archivos'] += 1
+
+    with open(zip_path, 'rb') as f:
+        assert f.read() == before
+    assert not os.path.exists(zip_path + fd.ARCHIVE_JOURNAL_SUFFIX)
+
+
+def test_monthly_runs_keep_one_manifest_each_inside_the_zip(fd):
+    for names in (['2025-Noviembre/Semana_47/a.pdf'], ['2025-Noviembre/Semana_47/b.pdf']):
+        paths = make_downloads(fd, names)
+        fd.create_zip_file(paths, 'glosas', append_monthly=True)
+
+    desktop = sorted(os.listdir(fd.desktop_dir()))
+    assert desktop == ['GLOSAS_2025-Noviembre.zip']
+    with zipfile.ZipFile(os.path.join(fd.desktop_dir(), desktop[0])) as zf:
+        manifests = [name for name in zf.namelist() if fd.MANIFEST_ENTRY_PATTERN.match(name)]
+    assert len(manifests) == len(set(manifests)) == 2
+
+
+def stored_entries(fd, tmp_path, count=5, size=4096):
+    """PDF de prueba con su (CRC32, bytes), como los entrega AttachmentStore"""
+    checksums = {}
+    for n in range(count):
+        data = os.urandom(size + n)
+        path = tmp_path / f"GLOSAS_{n:03d}.pdf"
+        path.write_bytes(data)
+        checksums[os.path.normpath(str(path))] = (zlib.crc32(data), len(data))
+    return checksums
+
+
+@pytest.mark.parametrize('internals', ['actuales', 'sin atributos internos'])
+def test_stored_entries_round_trip_with_zip64(fd, tmp_path, monkeypatch, internals):
+    # Límites ZIP64 bajos: encabezados locales, directorio central y fin de directorio pasan a ZIP64
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1024)
+    monkeypatch.setattr(zipfile, 'ZIP_FILECOUNT_LIMIT', 3)
+    if internals != 'actuales':
+        monkeypatch.setattr(fd, 'ZIPFILE_INTERNALS', fd.ZIPFILE_INTERNALS + ('_no_existe',))
+    checksums = stored_entries(fd, tmp_path)
+    base_path = str(tmp_path / 'prueba')
+    with fd.ArchiveWriter(base_path, checksums=checksums) as writer:
+        for path in sorted(checksums):
+            writer.add(path, f"2025-Noviembre/{os.path.basename(path)}")
+
+    assert sum(count for count, _ in writer.stored.values()) == len(checksums)
+    assert ('zipfile' in writer.stored) == (internals != 'actuales')
+    with open(f"{base_path}.zip", 'rb') as f:
+        assert zipfile.stringEndArchive64 in f.read()
+    with zipfile.ZipFile(f"{base_path}.zip") as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert len(infos) == len(checksums)
+        for info, path in zip(infos, sorted(checksums)):
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert (info.CRC, info.file_size) == checksums[path]
+            with open(path, 'rb') as f:
+                assert zf.read(info) == f.read()
@@ -0,0 +1,44 @@
+import random
+from array import array
+
+from file_downloader import MASK64, CompactIdIndex
+
+
+def test_matches_a_set_across_merges(monkeypatch):
+    monkeypatch.setattr('file_downloader.ID_INDEX_MERGE_EVERY', 16)
+    rnd = random.Random(7)
+    index, expected = CompactIdIndex(), set()
+    for _ in range(2000):
+        value = rnd.getrandbits(64)
+        assert index.add(value) == (value not in expected)
+        expected.add(value)
+    assert len(index) == len(expected)
+    assert len(index._sorted) > len(index._recent)
+    assert list(index._sorted) == sorted(index._sorted)
+    assert all(value in index for value in expected)
+    assert not any(rnd.getrandbits(64) in index for _ in range(2000))
+
+
+def test_repeated_add_returns_false():
+    index = CompactIdIndex(array('Q', [1, 5, 9]))
+    assert not index.add(5)
+    assert index.add(6)
+    assert not index.add(6)
+    assert len(index) == 4
+
+
+def test_negative_values_are_masked_to_64_bits():
+    # SQLite guarda con signo los IDs >= 2**63
+    index = CompactIdIndex()
+    index.add(-1)
+    assert MASK64 in index and -1 in index
+
+
+def test_discard_from_buffer_and_sorted_array():
+    index = CompactIdIndex(array('Q', [1, 5, 9]))
+    index.add(7)
+    index.discard(7)
+    index.discard(5)
+    index.discard(100)
+    assert 7 not in index and 5 not in index
+    assert len(index) == 2
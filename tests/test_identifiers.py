@@ -0,0 +1,27 @@
+import pytest
+
+from file_downloader import parse_filename_identifiers
+
+
+@pytest.mark.parametrize('filename, expected', [
+    ('GLOSAS PRESTADOR 760010379901_200515846.pdf', ('GLOSAS PRESTADOR', '760010379901', '200515846')),
+    ('Glosas_prestador 890303461-2_FE12345.xlsx', ('GLOSAS PRESTADOR', '890303461', 'FE12345')),
+    ('DEVOLUCION 8903034612_77.pdf', ('DEVOLUCION', '8903034612', '77')),
+    ('890303461_fv001.PDF', ('', '890303461', 'FV001')),
+])
+def test_parses_nit_and_invoice(filename, expected):
+    ids = parse_filename_identifiers(filename)
+    assert (ids['tipo'], ids['nit'], ids['factura']) == expected
+
+
+@pytest.mark.parametrize('filename', [
+    'GLOSAS 20251121_100112.zip',
+    'GLOSAS_20251121_100112.manifiesto.csv',
+    'NIT 890303461-2 FE 12345.pdf',
+    'GLOSAS PRESTADOR 12345678_200515846.pdf',
+    'GLOSAS PRESTADOR 12345678901_200515846.pdf',
+    'GLOSAS PRESTADOR 7600103799012_200515846.pdf',
+    'informe_final.pdf',
+])
+def test_rejects_names_without_identifiers(filename):
+    assert parse_filename_identifiers(filename) is None
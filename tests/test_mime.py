@@ -0,0 +1,54 @@
+from file_downloader import iter_attachment_parts
+
+
+def attachment(name, att_id=None, mime='application/pdf'):
+    return {'mimeType': mime, 'filename': name, 'body': {'attachmentId': att_id or f"id-{name}", 'size': 10}}
+
+
+def multipart(*parts, mime='multipart/mixed'):
+    return {'mimeType': mime, 'filename': '', 'body': {'size': 0}, 'parts': list(parts)}
+
+
+def forwarded(*parts, name='reenviado.eml'):
+    return {'mimeType': 'message/rfc822', 'filename': name, 'body': {'attachmentId': f"id-{name}"},
+            'parts': list(parts)}
+
+
+def names(payload, **kw):
+    return [part['filename'] for part in iter_attachment_parts(payload, **kw)]
+
+
+def test_keeps_message_order_and_skips_bodies():
+    payload = multipart(
+        multipart({'mimeType': 'text/plain', 'filename': '', 'body': {'data': 'aG9sYQ=='}},
+                  {'mimeType': 'text/html', 'filename': '', 'body': {'data': 'aG9sYQ=='}},
+                  mime='multipart/alternative'),
+        attachment('a.pdf'),
+        multipart(attachment('b.xlsx'), {'mimeType': 'image/png', 'filename': 'logo.png', 'body': {'data': 'eA=='}},
+                  mime='multipart/related'),
+        attachment('c.pdf'),
+    )
+    assert names(payload) == ['a.pdf', 'b.xlsx', 'c.pdf']
+
+
+def test_keyword_filter_ignores_case():
+    payload = multipart(attachment('GLOSAS 1.pdf'), attachment('otro.pdf'), attachment('glosas_2.xlsx'))
+    assert names(payload, keyword='glosas') == ['GLOSAS 1.pdf', 'glosas_2.xlsx']
+    assert names(payload, keyword='GLOSAS') == ['GLOSAS 1.pdf', 'glosas_2.xlsx']
+
+
+def test_opens_forwarded_messages_up_to_the_limit():
+    inner = forwarded(attachment('dentro2.pdf'), name='nivel2.eml')
+    payload = multipart(attachment('a.pdf'), forwarded(attachment('dentro1.pdf'), inner, name='nivel1.eml'),
+                        attachment('z.pdf'))
+
+    assert names(payload) == ['a.pdf', 'dentro1.pdf', 'dentro2.pdf', 'z.pdf']
+    assert names(payload, max_forward_depth=1) == ['a.pdf', 'dentro1.pdf', 'nivel2.eml', 'z.pdf']
+    assert names(payload, max_forward_depth=0) == ['a.pdf', 'nivel1.eml', 'z.pdf']
+
+
+def test_deep_trees_do_not_recurse():
+    payload = attachment('hoja.pdf')
+    for _ in range(5000):
+        payload = multipart(payload)
+    assert names(payload) == ['hoja.pdf']
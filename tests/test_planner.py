@@ -0,0 +1,76 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DATE = datetime(2025, 11, 21, 10, 0)
+FOLDER = '2025-Noviembre/Semana_47'
+
+
+class SlowSink:
+    """Destino en memoria cuyo listado tarda, como un LIST de S3"""
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def listdir(self, folder):
+        with self._lock:
+            self.calls.append(folder)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        threading.Event().wait(0.05)
+        with self._lock:
+            self.active -= 1
+        return set(self.existing)
+
+
+def suffix(data):
+    return hashlib.sha256(data).hexdigest()[:8]
+
+
+def test_collisions_get_content_suffix(fd):
+    planner = fd.PathPlanner(SlowSink(existing={'2025-11-21_glosa.pdf'}))
+
+    first = planner.plan(b'uno', 'glosa.pdf', DATE)
+    second = planner.plan(b'dos', 'glosa.pdf', DATE)
+    repeated = planner.plan(b'uno', 'glosa.pdf', DATE)
+
+    assert first == f"{FOLDER}/2025-11-21_glosa_{suffix(b'uno')}.pdf"
+    assert second == f"{FOLDER}/2025-11-21_glosa_{suffix(b'dos')}.pdf"
+    assert repeated == f"{FOLDER}/2025-11-21_glosa_{suffix(b'uno')}_2.pdf"
+
+
+def test_archived_names_count_as_taken(fd):
+    planner = fd.PathPlanner(SlowSink(), archived=lambda folder: {'2025-11-21_glosa.pdf'})
+    assert planner.plan(b'uno', 'glosa.pdf', DATE) == f"{FOLDER}/2025-11-21_glosa_{suffix(b'uno')}.pdf"
+
+
+def test_each_folder_is_listed_once_and_outside_the_lock(fd):
+    sink = SlowSink()
+    planner = fd.PathPlanner(sink)
+    jobs = [(f"glosa_{n}.pdf", datetime(2025, month, 3)) for n in range(10) for month in (1, 4, 7, 10)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        paths = list(pool.map(lambda job: planner.plan(job[0].encode(), *job), jobs))
+
+    assert len(set(paths)) == len(jobs)
+    assert sorted(sink.calls) == sorted(set(sink.calls)) and len(sink.calls) == 4
+    assert sink.max_active > 1
+
+
+def test_failed_listing_is_retried(fd):
+    class FlakySink(SlowSink):
+        def listdir(self, folder):
+            if not self.calls:
+                self.calls.append(folder)
+                raise OSError('sin conexión')
+            return super().listdir(folder)
+
+    planner = fd.PathPlanner(FlakySink())
+    try:
+        planner.plan(b'uno', 'glosa.pdf', DATE)
+    except OSError:
+        pass
+    assert planner.plan(b'uno', 'glosa.pdf', DATE) == f"{FOLDER}/2025-11-21_glosa.pdf"
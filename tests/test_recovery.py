@@ -0,0 +1,100 @@
+import os
+import subprocess
+import sys
+import threading
+import zipfile
+
+
+def dead_pid():
+    """pid de un proceso que ya terminó"""
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+def make_file(directory, name, data=b'contenido'):
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_removes_only_partials_of_finished_processes(fd):
+    stale = make_file(fd.APPDATA_DIR, f"glosas_estado.db.{dead_pid()}.1.part")
+    live = make_file(fd.APPDATA_DIR, f"token.json.{os.getpid()}.1.part")
+    attachment = make_file(fd.DOWNLOAD_DIR, 'x/2025-11-21_informe.part')
+    desktop_stale = make_file(fd.desktop_dir(), f"GLOSAS_2025-Noviembre.zip.{dead_pid()}.7.part")
+    desktop_other = make_file(fd.desktop_dir(), 'notas.part')
+
+    assert fd.recover_partial_outputs() == 2
+    assert not os.path.exists(stale) and not os.path.exists(desktop_stale)
+    assert os.path.exists(live) and os.path.exists(attachment) and os.path.exists(desktop_other)
+
+
+def test_sink_listdir_cleans_only_the_listed_folder(fd, tmp_path):
+    root = str(tmp_path / 'drive')
+    folder = '2025-Noviembre/Semana_47'
+    stale = f"2025-11-21_a.pdf.{dead_pid()}.3.part"
+    live = f"2025-11-21_b.pdf.{os.getpid()}.3.part"
+    make_file(root, f"{folder}/{stale}")
+    make_file(root, f"{folder}/{live}")
+    make_file(root, f"{folder}/2025-11-21_c.pdf")
+    other = make_file(root, f"2025-Octubre/Semana_40/x.pdf.{dead_pid()}.3.part")
+
+    names = fd.LocalDirectorySink(root).listdir(folder)
+
+    assert names == {live, '2025-11-21_c.pdf'}
+    assert not os.path.exists(os.path.join(root, *folder.split('/'), stale))
+    assert os.path.exists(other)
+
+
+def append_interrupted(fd, base_path, source):
+    """Anexa una entrada y deja el ZIP sin cerrar, como si el proceso hubiera terminado a la mitad"""
+    writer = fd.ArchiveWriter(base_path, append=True)
+    writer.add(source, '2025-Noviembre/Semana_47/nuevo.pdf')
+    writer._zip.fp.flush()
+    writer._release_lock()
+    return writer
+
+
+def test_restores_interrupted_monthly_append(fd, tmp_path):
+    source = make_file(str(tmp_path), 'a.pdf', b'%PDF' * 1000)
+    base_path = fd.archive_base_path('glosas')
+    with fd.ArchiveWriter(base_path, append=True) as writer:
+        writer.add(source, '2025-Noviembre/Semana_47/a.pdf')
+    zip_path = writer.volumes[0][0]
+    size = os.path.getsize(zip_path)
+
+    append_interrupted(fd, base_path, source)
+    assert os.path.exists(zip_path + fd.ARCHIVE_JOURNAL_SUFFIX)
+
+    fd.recover_partial_outputs()
+
+    assert not os.path.exists(zip_path + fd.ARCHIVE_JOURNAL_SUFFIX)
+    assert os.path.getsize(zip_path) == size
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.namelist() == ['2025-Noviembre/Semana_47/a.pdf']
+        assert zf.testzip() is None
+
+
+def test_does_not_roll_back_an_append_in_progress(fd, tmp_path):
+    source = make_file(str(tmp_path), 'a.pdf', b'%PDF' * 1000)
+    base_path = fd.archive_base_path('glosas')
+    with fd.ArchiveWriter(base_path, append=True) as writer:
+        writer.add(source, '2025-Noviembre/Semana_47/a.pdf')
+
+    # Otra ejecución está anexando: la recuperación espera el bloqueo y no toca el ZIP
+    writer = fd.ArchiveWriter(base_path, append=True)
+    writer.add(source, '2025-Noviembre/Semana_47/b.pdf')
+    recovery = threading.Thread(target=fd.recover_partial_outputs)
+    recovery.start()
+    recovery.join(0.3)
+    assert recovery.is_alive()
+    zip_path = writer.close()[0]
+    recovery.join(10)
+    assert not recovery.is_alive()
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.namelist() == ['2025-Noviembre/Semana_47/a.pdf', '2025-Noviembre/Semana_47/b.pdf']
+    assert not os.path.exists(zip_path + fd.ARCHIVE_JOURNAL_SUFFIX)
@@ -0,0 +1,81 @@
+import json
+import os
+
+MSG_IDS = ['18c0000000000001', '18c0000000000002', 'ffffffffffffff01']
+
+
+def state_db(tmp_path):
+    return str(tmp_path / 'estado.db')
+
+
+def test_ids_survive_reopen_including_high_bit(fd, tmp_path):
+    state = fd.ProcessedState('GLOSAS', path=state_db(tmp_path))
+    for msg_id in MSG_IDS:
+        state.add(msg_id)
+    state.close()
+
+    state = fd.ProcessedState('GLOSAS', path=state_db(tmp_path))
+    assert len(state) == 3
+    assert all(msg_id in state for msg_id in MSG_IDS)
+    assert '18c0000000000003' not in state
+    state.close()
+
+
+def test_keyword_is_case_insensitive(fd, tmp_path):
+    state = fd.ProcessedState('glosas', path=state_db(tmp_path))
+    state.add(MSG_IDS[0])
+    state.close()
+
+    state = fd.ProcessedState(' Glosas ', path=state_db(tmp_path))
+    assert state.keyword == 'GLOSAS'
+    assert MSG_IDS[0] in state
+    state.close()
+
+
+def test_merges_state_saved_under_other_case(fd, tmp_path):
+    # Base de una versión que distinguía mayúsculas: dos estados para la misma palabra
+    path = state_db(tmp_path)
+    state = fd.ProcessedState('GLOSAS', path=path)
+    state.add(MSG_IDS[0])
+    state.close()
+    state = fd.ProcessedState('GLOSAS', path=path)
+    with state._conn:
+        state._conn.execute("INSERT INTO matchers (keyword) VALUES ('glosas')")
+        variant = state._conn.execute("SELECT id FROM matchers WHERE keyword = 'glosas'").fetchone()[0]
+        state._conn.execute("INSERT INTO processed VALUES (?, ?)", (variant, fd.gmail_id_to_int(MSG_IDS[1])))
+        state._conn.execute("INSERT INTO history_cursor VALUES (?, 42, 0)", (variant,))
+    state.close()
+
+    state = fd.ProcessedState('glosas', path=path)
+    assert MSG_IDS[0] in state and MSG_IDS[1] in state
+    assert state.get_history_id() == 42
+    assert [row[0] for row in state._conn.execute("SELECT keyword FROM matchers")] == ['GLOSAS']
+    state.close()
+
+
+def test_migrates_legacy_file_under_the_run_keyword(fd, tmp_path):
+    with open(fd.PROCESSED_FILE, 'w', encoding='utf-8') as f:
+        json.dump(MSG_IDS[:2], f)
+
+    state = fd.ProcessedState('facturas', path=state_db(tmp_path))
+    assert all(msg_id in state for msg_id in MSG_IDS[:2])
+    state.close()
+    assert not os.path.exists(fd.PROCESSED_FILE)
+    assert os.path.exists(fd.PROCESSED_FILE + '.migrado')
+
+    other = fd.ProcessedState('GLOSAS', path=state_db(tmp_path))
+    assert len(other) == 0
+    other.close()
+
+
+def test_failed_writes_are_not_saved(fd, tmp_path):
+    state = fd.ProcessedState('GLOSAS', path=state_db(tmp_path))
+    state.add(MSG_IDS[0])
+    state.add(MSG_IDS[1])
+    state.save(lambda: {MSG_IDS[1]})
+    assert MSG_IDS[1] not in state
+    state.close()
+
+    state = fd.ProcessedState('GLOSAS', path=state_db(tmp_path))
+    assert MSG_IDS[0] in state and MSG_IDS[1] not in state
+    state.close()